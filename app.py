@@ -1,19 +1,43 @@
 import os
 import re
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+import json
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, Response, get_flashed_messages, g, has_app_context, stream_template, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_caching import Cache
 import pandas as pd
 import sqlite3
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from io import BytesIO  # ← ДОБАВИТЬ ЭТОТ ИМПОРТ
-from openpyxl import Workbook  # ← И ЭТОТ ТОЖЕ
+from openpyxl import Workbook, load_workbook  # ← И ЭТОТ ТОЖЕ
 from openpyxl.styles import Font  # ← И ЭТОТ ДЛЯ ФОРМАТИРОВАНИЯ
+from openpyxl.cell import WriteOnlyCell
 
 # Сначала создаем app, потом импортируем конфиг
 app = Flask(__name__)
 
-cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+class RowJSONProvider(DefaultJSONProvider):
+    """JSON-провайдер, который сериализует sqlite3.Row без промежуточных словарей"""
+    # Без сортировки ключей каждого объекта и без \uXXXX для кириллицы:
+    # на больших страницах это заметно быстрее и вдвое короче для русских названий
+    sort_keys = False
+    ensure_ascii = False
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row):
+            return dict(zip(o.keys(), o))
+        return DefaultJSONProvider.default(o)
+
+app.json = RowJSONProvider(app)
+
+cache = Cache(config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
 cache.init_app(app)
 
 # Определяем среду и загружаем конфиг
@@ -61,11 +85,54 @@ def check_authentication():
 
 
 
+# Пул соединений: у каждого потока свои свободные соединения (sqlite3 привязывает их к потоку)
+db_pool = threading.local()
+DB_POOL_SIZE = 4
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() откатывает незавершенную транзакцию и возвращает его в пул"""
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        free_connections = db_pool.__dict__.setdefault('free', [])
+        if self in free_connections:
+            # Повторный close() - соединение уже в пуле
+            return
+        if len(free_connections) < DB_POOL_SIZE:
+            free_connections.append(self)
+        else:
+            super().close()
+
 def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
+    """
+    Выдает соединение из пула текущего потока или открывает новое.
+    Вложенные вызовы получают разные соединения; conn.close() возвращает соединение в пул,
+    поэтому кэш подготовленных выражений и настройки переживают запрос.
+    """
+    free_connections = db_pool.__dict__.setdefault('free', [])
+    if free_connections:
+        conn = free_connections.pop()
+    else:
+        # Кэш подготовленных выражений: одинаковый текст SQL не разбирается повторно
+        conn = sqlite3.connect(app.config['DATABASE'], factory=PooledConnection, cached_statements=512)
+        conn.row_factory = sqlite3.Row
+        # Настройки соединения (WAL хранится в самой базе и включается в upgrade_db)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA mmap_size=268435456')
+    
+    # Выданные за запрос соединения запоминаем, чтобы вернуть их в пул при teardown
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
     return conn
 
+@app.teardown_appcontext
+def release_db_connections(exception):
+    """Возвращает в пул соединения, которые обработчик не закрыл (например, из-за исключения)"""
+    for conn in g.pop('db_connections', []):
+        conn.close()
+
 def init_db():
     conn = get_db_connection()
     with app.open_resource('schema.sql', mode='r') as f:
@@ -109,13 +176,272 @@ def init_db():
     conn.commit()
     conn.close()
 
+def upgrade_db():
+    """Доводит существующую базу до актуальной схемы: новые таблицы и индексы"""
+    conn = get_db_connection()
+    
+    # Режим WAL сохраняется в файле базы - достаточно включить один раз при старте
+    conn.execute('PRAGMA journal_mode=WAL')
+    
+    # Колонки, которых нет в старых базах (до применения схемы: на них ссылаются триггеры)
+    parts_columns = {row['name'] for row in conn.execute('PRAGMA table_info(parts_catalog)')}
+    if parts_columns and 'brand_name' not in parts_columns:
+        conn.execute('ALTER TABLE parts_catalog ADD COLUMN brand_name TEXT')
+        conn.execute('''
+            UPDATE parts_catalog
+            SET brand_name = (SELECT name FROM brands WHERE id = parts_catalog.brand_id)
+        ''')
+    
+    # Перед уникальным индексом статистики оставляем по одной (последней) записи на ключ
+    has_sales_unique = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_sales_stats_unique'"
+    ).fetchone()
+    has_sales_statistics = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sales_statistics'"
+    ).fetchone()
+    if has_sales_statistics and not has_sales_unique:
+        conn.execute('''
+            DELETE FROM sales_statistics
+            WHERE id NOT IN (
+                SELECT MAX(id) FROM sales_statistics GROUP BY part_id, data_type, period
+            )
+        ''')
+    
+    # Таблицы, которые после создания нужно заполнить по уже накопленным данным
+    has_latest_prices = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'latest_expected_price'"
+    ).fetchone()
+    has_catalog_fts = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'parts_catalog_fts'"
+    ).fetchone()
+    
+    with app.open_resource('schema.sql', mode='r') as f:
+        conn.executescript(f.read())
+    
+    if not has_latest_prices:
+        conn.execute('''
+            INSERT OR REPLACE INTO latest_expected_price (part_id, price_id, price_rub, effective_date)
+            SELECT part_id, id, price_rub, effective_date
+            FROM (
+                SELECT 
+                    part_id, id, price_rub, effective_date,
+                    ROW_NUMBER() OVER (PARTITION BY part_id ORDER BY effective_date DESC, created_at DESC) as rn
+                FROM expected_sale_prices
+            )
+            WHERE rn = 1
+        ''')
+    
+    if not has_catalog_fts:
+        conn.execute("INSERT INTO parts_catalog_fts (parts_catalog_fts) VALUES ('rebuild')")
+    
+    # Обновляем статистику планировщика под новые индексы
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+# Все, что не латиница и не цифры, из артикула удаляется
+ARTICLE_JUNK_RE = re.compile(r'[^a-zA-Z0-9]')
+
+# Правила распознавания колонок прайс-листа: первое совпавшее правило побеждает
+PRICE_LIST_COLUMN_RULES = [
+    (re.compile('артикул'), 'article'),
+    (re.compile('марка'), 'brand'),
+    (re.compile('название|наименование'), 'name'),
+    (re.compile('цена'), 'price'),
+    (re.compile('вес'), 'weight'),
+]
+
+# Ожидаемые цены продажи
+EXPECTED_PRICES_COLUMN_RULES = [
+    (re.compile('артикул'), 'article'),
+    (re.compile('марка'), 'brand'),
+    (re.compile('цена'), 'price'),
+    (re.compile('дата'), 'date'),
+    (re.compile('примеч'), 'notes'),
+]
+
+# Статистика продаж (загрузка и предварительная проверка файла)
+SALES_STATISTICS_COLUMN_RULES = [
+    (re.compile('артикул'), 'article'),
+    (re.compile('марка'), 'brand'),
+    (re.compile('период|дата'), 'period'),
+    (re.compile('количество|продажи'), 'quantity'),
+    (re.compile('группа'), 'volume_group'),
+    (re.compile('запрос'), 'requests'),
+    (re.compile('источник'), 'source'),
+    (re.compile('примеч'), 'notes'),
+]
+
+# Каталог: дополнительный артикул и английское название проверяются раньше общих правил
+CATALOG_COLUMN_RULES = [
+    (re.compile('доп.*артикул|артикул.*доп'), 'additional_article'),
+    (re.compile('артикул'), 'main_article'),
+    (re.compile('марка'), 'brand'),
+    (re.compile('название.*англ|англ.*название'), 'name_en'),
+    (re.compile('название'), 'name_ru'),
+    (re.compile('вес'), 'weight'),
+    (re.compile('коэф.*объем|объем.*коэф'), 'volume_coefficient'),
+    (re.compile('примеч'), 'notes'),
+]
+
+# Позиции заказа из Excel
+ORDER_ITEMS_COLUMN_RULES = [
+    (re.compile('марка'), 'brand'),
+    (re.compile('артикул'), 'article'),
+    (re.compile('количество|кол-во'), 'quantity'),
+]
+
+# Колонка с артикулами для сопоставления брендов
+ARTICLE_COLUMN_RE = re.compile('артикул|article')
+
+# Время жизни кэша курсов валют, секунд
+CURRENCY_RATES_TTL = 300
+
+# Время жизни кэша сравнения поставщиков, секунд
+SUPPLIER_COMPARISON_TTL = 120
+
+# Время жизни кэша общего количества строк в списках с пагинацией, секунд
+COUNT_CACHE_TTL = 60
+
+# Сколько дней назад еще учитываются цены других поставщиков региона
+MARKET_PRICE_WINDOW_DAYS = 1300
+
+# SQL загрузки прайс-листа: постоянный текст, чтобы переиспользовать подготовленные выражения
+INSERT_PRICE_LIST_SQL = 'INSERT INTO price_lists (supplier_id, upload_date, file_name) VALUES (?, ?, ?)'
+UPDATE_PART_DETAILS_SQL = 'UPDATE parts_catalog SET name_ru = ?, weight = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?'
+INSERT_PART_SQL = 'INSERT INTO parts_catalog (brand_id, main_article, name_ru, weight) VALUES (?, ?, ?, ?)'
+SELECT_NEW_PARTS_SQL = 'SELECT id, brand_id, main_article FROM parts_catalog WHERE id > ?'
+INSERT_PRICE_SQL = 'INSERT INTO prices (price_list_id, part_id, price) VALUES (?, ?, ?)'
+
+# Значения фильтров страницы анализа: (вид, название). Названия уникальны, поэтому без DISTINCT;
+# порядок UNION ALL без внешнего ORDER BY не гарантирован - списки сортируются после разбора
+SELECT_ANALYSIS_FILTERS_SQL = '''
+    SELECT 'brands' AS kind, name FROM brands WHERE name IS NOT NULL
+    UNION ALL
+    SELECT 'suppliers', name FROM suppliers
+    UNION ALL
+    SELECT 'regions', name FROM regions
+'''
+
+# SQL загрузки статистики продаж: одна запись на (деталь, тип данных, период)
+SELECT_SALES_STATISTIC_KEYS_SQL = '''
+    SELECT part_id, period FROM sales_statistics 
+    WHERE data_type = ? AND part_id IN (SELECT value FROM json_each(?))
+'''
+UPSERT_SALES_STATISTIC_SQL = '''
+    INSERT INTO sales_statistics 
+    (part_id, data_type, period, quantity, volume_group, 
+     requests_per_month, source_name, notes)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (part_id, data_type, period) DO UPDATE SET
+        quantity = excluded.quantity,
+        volume_group = excluded.volume_group,
+        requests_per_month = excluded.requests_per_month,
+        source_name = excluded.source_name,
+        notes = excluded.notes,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
 def normalize_article(article):
     """Нормализация артикула: только буквы и цифры в верхнем регистре"""
     if pd.isna(article) or article == '':
         return ''
-    cleaned = re.sub(r'[^a-zA-Z0-9]', '', str(article))
+    cleaned = ARTICLE_JUNK_RE.sub('', str(article))
     return cleaned.upper()
 
+def normalize_articles(series):
+    """Векторная версия normalize_article для колонки DataFrame"""
+    return series.fillna('').astype(str).str.replace(ARTICLE_JUNK_RE, '', regex=True).str.upper()
+
+def map_columns(columns, rules):
+    """Сопоставляет колонки Excel с полями по списку правил (pattern, поле)"""
+    column_mapping = {}
+    for col in columns:
+        col_lower = str(col).lower()
+        for pattern, target in rules:
+            if pattern.search(col_lower):
+                column_mapping[col] = target
+                break
+    return column_mapping
+
+# Текстовые поля, которые pandas иначе превращает в числа (артикул 12345 -> 12345.0)
+TEXT_COLUMN_FIELDS = ('article', 'brand', 'main_article', 'additional_article')
+
+def read_excel_columns(source, rules):
+    """
+    Читает из Excel только распознанные колонки. Загруженный файл сохраняется
+    во временный файл, .xlsx читается потоково через openpyxl (read_only) -
+    без копии файла в памяти и без разбора ненужных колонок.
+    Текстовые поля читаются как строки.
+    """
+    if hasattr(source, 'save'):
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(source.filename)[1], delete=False) as tmp:
+            source.save(tmp)
+        try:
+            return read_excel_columns(tmp.name, rules)
+        finally:
+            os.remove(tmp.name)
+    
+    if not source.endswith('.xlsx'):
+        # Старый формат .xls openpyxl не читает - заголовок, затем только нужные колонки
+        column_mapping = map_columns(pd.read_excel(source, nrows=0).columns, rules)
+        df = pd.read_excel(
+            source,
+            usecols=list(column_mapping),
+            dtype={col: str for col, field in column_mapping.items() if field in TEXT_COLUMN_FIELDS}
+        )
+        return df.rename(columns=column_mapping)
+    
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        # Первый лист, как у pd.read_excel: активный лист зависит от того, как файл сохранили
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        column_mapping = map_columns([col for col in header if col is not None], rules)
+        
+        # Позиция каждой распознанной колонки; при повторе поля берется первая колонка
+        positions = {}
+        for index, col in enumerate(header):
+            field = column_mapping.get(col) if col is not None else None
+            if field and field not in positions:
+                positions[field] = index
+        
+        data = {field: [] for field in positions}
+        for row in rows:
+            for field, index in positions.items():
+                value = row[index] if index < len(row) else None
+                if value is not None and field in TEXT_COLUMN_FIELDS:
+                    value = str(value)
+                data[field].append(value)
+    finally:
+        workbook.close()
+    
+    return pd.DataFrame(data)
+
+def save_workbook_to_temp_file(workbook):
+    """
+    Сохраняет книгу Excel во временный файл и возвращает его, перемотанный в начало.
+    Система удаляет такой файл сама, когда сервер закроет его после отправки
+    """
+    export_file = tempfile.TemporaryFile(suffix='.xlsx')
+    workbook.save(export_file)
+    export_file.seek(0)
+    return export_file
+
+# Триграммный индекс не ищет подстроки короче трех символов
+FTS_MIN_TERM_LENGTH = 3
+
+def catalog_search_condition(term, columns):
+    """
+    Условие поиска подстроки term в колонках каталога (алиас pc) и его параметры.
+    Ищет по parts_catalog_fts, для слишком коротких строк - через LIKE.
+    """
+    if len(term) >= FTS_MIN_TERM_LENGTH:
+        match = '{' + ' '.join(columns) + '} : "' + term.replace('"', '""') + '"'
+        return 'pc.id IN (SELECT rowid FROM parts_catalog_fts WHERE parts_catalog_fts MATCH ?)', [match]
+    condition = ' OR '.join(f'pc.{column} LIKE ?' for column in columns)
+    return f'({condition})', [f'%{term}%'] * len(columns)
+
 def find_brand_by_name(brand_name, conn):
     """
     Ищет бренд по названию, учитывая синонимы и регистр.
@@ -127,6 +453,12 @@ def find_brand_by_name(brand_name, conn):
     # Нормализуем название для поиска
     normalized_name = brand_name.upper().strip()
     
+    # Словарь брендов в памяти процесса (только зафиксированные данные)
+    brand_id = get_brand_map().get(normalized_name)
+    if brand_id:
+        return brand_id
+    
+    # Бренды, созданные в текущей транзакции, есть только в базе
     # Сначала ищем точное совпадение в основных брендах (без учета регистра)
     brand = conn.execute('''
         SELECT id FROM brands 
@@ -185,6 +517,119 @@ def get_or_create_brand(brand_name, conn):
     
     return brand_id
 
+def load_brand_map(conn):
+    """
+    Загружает все бренды и их синонимы одним проходом.
+    Возвращает словарь {нормализованное название: ID бренда}.
+    """
+    brand_map = {}
+    for synonym in conn.execute('SELECT brand_id, synonym_name FROM brand_synonyms'):
+        brand_map[synonym['synonym_name'].upper().strip()] = synonym['brand_id']
+    
+    # Основные названия брендов важнее синонимов
+    for brand in conn.execute('SELECT id, name FROM brands'):
+        brand_map[brand['name'].upper().strip()] = brand['id']
+    
+    return brand_map
+
+# Словарь брендов процесса: строится по зафиксированным данным отдельным соединением,
+# сбрасывается после записи брендов и синонимов (invalidate_brand_map)
+brand_map_cache = None
+brand_map_lock = threading.Lock()
+
+def get_brand_map():
+    """Возвращает общий словарь брендов {нормализованное название: ID} (не изменять)"""
+    global brand_map_cache
+    with brand_map_lock:
+        if brand_map_cache is None:
+            conn = get_db_connection()
+            brand_map_cache = load_brand_map(conn)
+            conn.close()
+        return brand_map_cache
+
+def invalidate_brand_map():
+    """Сбрасывает словарь брендов; вызывается после фиксации изменений брендов"""
+    global brand_map_cache
+    with brand_map_lock:
+        brand_map_cache = None
+
+def load_parts_by_brand(brand_ids, conn):
+    """
+    Загружает детали указанных брендов одним запросом.
+    Возвращает словарь {(brand_id, артикул): деталь}, где артикул - основной
+    или дополнительный; совпадение по основному артикулу приоритетнее.
+    """
+    rows = conn.execute('''
+        SELECT id, brand_id, main_article, additional_article, name_ru, weight
+        FROM parts_catalog
+        WHERE brand_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(brand_ids),)).fetchall()
+    
+    parts = {}
+    for row in rows:
+        if row['additional_article']:
+            parts.setdefault((row['brand_id'], row['additional_article']),
+                             {'id': row['id'], 'name_ru': row['name_ru'], 'weight': row['weight']})
+    for row in rows:
+        parts[(row['brand_id'], row['main_article'])] = {
+            'id': row['id'], 'name_ru': row['name_ru'], 'weight': row['weight']
+        }
+    return parts
+
+def resolve_brand_ids(brand_names, conn, new_brands=None):
+    """
+    Находит или создает бренды для набора названий, сверяясь со словарем брендов.
+    Возвращает словарь {название: ID бренда}; созданные названия добавляет в new_brands.
+    """
+    brand_map = dict(get_brand_map())
+    brand_ids = {}
+    for brand_name in set(brand_names):
+        if not brand_name:
+            continue
+        normalized_name = brand_name.upper().strip()
+        if normalized_name not in brand_map:
+            brand_map[normalized_name] = get_or_create_brand(brand_name, conn)
+            if new_brands is not None:
+                new_brands.add(brand_name)
+        brand_ids[brand_name] = brand_map[normalized_name]
+    return brand_ids
+
+def load_part_ids(keys, conn):
+    """
+    Ищет детали по парам (brand_id, основной артикул) одним запросом.
+    Возвращает словарь {(brand_id, артикул): part_id}; при дублях - первая деталь.
+    """
+    part_ids = {}
+    for row in conn.execute('''
+        SELECT pc.id, pc.brand_id, pc.main_article
+        FROM json_each(?) j
+        JOIN parts_catalog pc 
+            ON pc.brand_id = json_extract(j.value, '$[0]') 
+           AND pc.main_article = json_extract(j.value, '$[1]')
+        ORDER BY pc.id
+    ''', (json.dumps(list(keys)),)):
+        part_ids.setdefault((row['brand_id'], row['main_article']), row['id'])
+    return part_ids
+
+def resolve_part_ids(pairs, conn, new_brands=None):
+    """
+    Пакетный аналог get_or_create_part_in_catalog для пар (бренд, артикул).
+    Возвращает словарь {(бренд, артикул): part_id}; пустые пары пропускаются.
+    """
+    pairs = {(brand_name, article) for brand_name, article in pairs if brand_name and article}
+    brand_ids = resolve_brand_ids([brand_name for brand_name, _ in pairs], conn, new_brands)
+    
+    keys = {(brand_ids[brand_name], article) for brand_name, article in pairs}
+    part_ids = load_part_ids(keys, conn)
+    
+    # Недостающие детали создаем одним пакетом и дочитываем их id
+    missing = keys - part_ids.keys()
+    if missing:
+        conn.executemany('INSERT INTO parts_catalog (brand_id, main_article) VALUES (?, ?)', sorted(missing))
+        part_ids.update(load_part_ids(missing, conn))
+    
+    return {(brand_name, article): part_ids[(brand_ids[brand_name], article)] for brand_name, article in pairs}
+
 def get_or_create_part_in_catalog(brand_name, article, conn):
     """Находит или создает деталь в каталоге, возвращает part_id"""
     if not brand_name or not article:
@@ -211,21 +656,71 @@ def get_or_create_part_in_catalog(brand_name, article, conn):
         )
         return cursor.lastrowid
 
-def normalize_volume_group(volume_group):
-    """Нормализует группу объема"""
-    if not volume_group:
+# Группы объема продаж: первое совпавшее правило побеждает
+VOLUME_GROUP_RULES = [
+    ('топ|top', 'top_sales'),
+    ('хорош|good', 'good_demand'),
+    ('низк|low', 'low_demand'),
+    ('отсут|no', 'no_demand'),
+]
+
+def normalize_volume_groups(series):
+    """Нормализует группы объема для колонки DataFrame; нераспознанные - None"""
+    volume_lower = series.fillna('').astype(str).str.lower()
+    result = pd.Series(None, index=series.index, dtype=object)
+    for pattern, group in VOLUME_GROUP_RULES:
+        result[result.isna() & volume_lower.str.contains(pattern, regex=True)] = group
+    return result
+
+# Схемы JSON-тел запросов: {поле: (тип, значение по умолчанию)}
+PART_UPDATE_FIELDS = {
+    'brand': (str, ''),
+    'main_article': (str, ''),
+    'additional_article': (str, ''),
+    'name_ru': (str, ''),
+    'name_en': (str, ''),
+    'weight': (float, None),
+    'volume_coefficient': (float, None),
+    'notes': (str, ''),
+}
+CURRENCY_RATE_FIELDS = {
+    'currency_code': (str, ''),
+    'rate_to_rub': (float, None),
+    'description': (str, ''),
+}
+DELIVERY_COST_FIELDS = {
+    'id': (int, None),
+    'region_id': (int, None),
+    'cost_per_kg': (float, None),
+    'min_cost': (float, None),
+    'description': (str, ''),
+}
+
+def parse_json_body(fields):
+    """Читает JSON-объект из тела запроса и приводит поля к типам схемы.
+    Возвращает словарь значений или None, если тело не объект или поле не приводится к типу"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
         return None
     
-    volume_lower = str(volume_group).lower()
-    if 'топ' in volume_lower or 'top' in volume_lower:
-        return 'top_sales'
-    elif 'хорош' in volume_lower or 'good' in volume_lower:
-        return 'good_demand'
-    elif 'низк' in volume_lower or 'low' in volume_lower:
-        return 'low_demand'
-    elif 'отсут' in volume_lower or 'no' in volume_lower:
-        return 'no_demand'
-    return None
+    values = {}
+    for name, (field_type, default) in fields.items():
+        value = data.get(name)
+        if value is None or (value == '' and field_type is not str):
+            values[name] = default
+        elif field_type is str:
+            if not isinstance(value, str):
+                return None
+            values[name] = value
+        else:
+            # Числа из полей формы приходят строками
+            if isinstance(value, bool):
+                return None
+            try:
+                values[name] = field_type(value)
+            except (TypeError, ValueError):
+                return None
+    return values
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -291,7 +786,7 @@ def api_order_calculate_supplier():
             return jsonify({'error': 'Supplier not found'}), 404
         
         # Получаем курсы валют и стоимость доставки
-        currency_rates = get_currency_rates(conn)
+        currency_rates = get_currency_rates()
         delivery_costs = get_delivery_costs(conn)
         
         # Рассчитываем цены для выбранного поставщика
@@ -394,7 +889,7 @@ def api_suppliers_list():
     
     conn.close()
     
-    return jsonify([dict(supplier) for supplier in suppliers])
+    return jsonify(suppliers)
 
 
 
@@ -452,7 +947,7 @@ def api_brands():
     if request.method == 'GET':
         brands = conn.execute('SELECT * FROM brands ORDER BY name').fetchall()
         conn.close()
-        return jsonify([dict(brand) for brand in brands])
+        return jsonify(brands)
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -479,6 +974,7 @@ def api_brands():
             )
             conn.commit()
             conn.close()
+            invalidate_brand_map()
             return jsonify({'success': True, 'id': cursor.lastrowid})
         except sqlite3.IntegrityError:
             conn.close()
@@ -497,7 +993,7 @@ def api_brand_synonyms():
             ORDER BY b.name, bs.synonym_name
         ''').fetchall()
         conn.close()
-        return jsonify([dict(synonym) for synonym in synonyms])
+        return jsonify(synonyms)
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -525,6 +1021,7 @@ def api_brand_synonyms():
             )
             conn.commit()
             conn.close()
+            invalidate_brand_map()
             return jsonify({'success': True})
         except sqlite3.IntegrityError:
             conn.close()
@@ -539,6 +1036,7 @@ def api_brand_synonyms():
         conn.execute('DELETE FROM brand_synonyms WHERE id = ?', (synonym_id,))
         conn.commit()
         conn.close()
+        invalidate_brand_map()
         return jsonify({'success': True})
 
 
@@ -556,32 +1054,12 @@ def api_validate_upload():
     
     if file and file.filename.endswith(('.xlsx', '.xls')):
         try:
-            df = pd.read_excel(file)
-            
-            # Маппинг колонок в зависимости от типа данных
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower: 
-                    column_mapping[col] = 'article'
-                elif 'марка' in col_lower: 
-                    column_mapping[col] = 'brand'
-                elif 'период' in col_lower or 'дата' in col_lower: 
-                    column_mapping[col] = 'period'
-                elif 'количество' in col_lower or 'продажи' in col_lower: 
-                    column_mapping[col] = 'quantity'
-                elif 'группа' in col_lower: 
-                    column_mapping[col] = 'volume_group'
-                elif 'запрос' in col_lower: 
-                    column_mapping[col] = 'requests'
-                elif 'источник' in col_lower: 
-                    column_mapping[col] = 'source'
-            
-            df = df.rename(columns=column_mapping)
+            # Читаем только распознанные колонки
+            df = read_excel_columns(file, SALES_STATISTICS_COLUMN_RULES)
             
             # Очистка данных
             if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
+                df['article'] = normalize_articles(df['article'])
             if 'brand' in df.columns:
                 df['brand'] = df['brand'].fillna('').astype(str).str.strip()
             
@@ -667,24 +1145,12 @@ def api_validate_price_list():
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_' + filename)
             file.save(filepath)
 
-            # Читаем Excel
-            df = pd.read_excel(filepath)
-            
-            # Определяем колонки
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower: column_mapping[col] = 'article'
-                elif 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'название' in col_lower or 'наименование' in col_lower: column_mapping[col] = 'name'
-                elif 'цена' in col_lower: column_mapping[col] = 'price'
-                elif 'вес' in col_lower: column_mapping[col] = 'weight'
-            
-            df = df.rename(columns=column_mapping)
+            # Читаем Excel: только распознанные колонки
+            df = read_excel_columns(filepath, PRICE_LIST_COLUMN_RULES)
             
             # Очистка данных
             if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
+                df['article'] = normalize_articles(df['article'])
             if 'brand' in df.columns:
                 df['brand'] = df['brand'].fillna('').astype(str).str.strip()
             
@@ -798,21 +1264,12 @@ def api_order_upload():
     
     if file and file.filename.endswith(('.xlsx', '.xls')):
         try:
-            df = pd.read_excel(file)
-            
-            # Маппинг колонок
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'артикул' in col_lower: column_mapping[col] = 'article'
-                elif 'количество' in col_lower or 'кол-во' in col_lower: column_mapping[col] = 'quantity'
-            
-            df = df.rename(columns=column_mapping)
+            # Читаем только распознанные колонки
+            df = read_excel_columns(file, ORDER_ITEMS_COLUMN_RULES)
             
             # Очистка данных
             if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
+                df['article'] = normalize_articles(df['article'])
             if 'brand' in df.columns:
                 df['brand'] = df['brand'].fillna('').astype(str).str.strip()
             
@@ -984,6 +1441,7 @@ def api_order_update_item():
             updates_made.append(f'цена продажи обновлена: {sale_price} руб')
         
         conn.commit()
+        cache.delete('expected_prices_count')
         
         return jsonify({
             'success': True,
@@ -1008,7 +1466,7 @@ def api_order_calculate():
     
     try:
         # Получаем актуальные курсы валют
-        currency_rates = get_currency_rates(conn)
+        currency_rates = get_currency_rates()
         
         # Получаем стоимость доставки по регионам
         delivery_costs = get_delivery_costs(conn)
@@ -1032,16 +1490,45 @@ def api_order_calculate():
     finally:
         conn.close()
 
-def get_currency_rates(conn):
-    """Получаем актуальные курсы валют"""
+@cache.memoize(timeout=CURRENCY_RATES_TTL)
+def get_currency_rates():
+    """Получаем актуальные курсы валют (кэшируются на 5 минут, сбрасываются при изменении курсов)"""
+    conn = get_db_connection()
+    # Сортируем по возрастанию, чтобы в словаре остался самый свежий курс
     rates = conn.execute('''
         SELECT currency_code, rate_to_rub 
         FROM currency_rates 
-        ORDER BY created_at DESC
+        ORDER BY created_at
     ''').fetchall()
+    conn.close()
     
     return {rate['currency_code']: rate['rate_to_rub'] for rate in rates}
 
+def invalidate_price_caches():
+    """Сбрасывает кэши, построенные по ценам и прайс-листам: страницу анализа и сравнение поставщиков"""
+    cache.delete('analysis_page')
+    cache.delete_memoized(load_supplier_comparison)
+
+def invalidate_currency_rate_caches():
+    """Сбрасывает кэши курсов валют и все, что по ним посчитано"""
+    cache.delete_memoized(get_currency_rates)
+    cache.delete_memoized(get_currency_rate_list)
+    cache.delete_memoized(check_currency_rates)
+    invalidate_price_caches()
+
+def cached_count(conn, count_query, params):
+    """
+    Общее количество строк для пагинации списков.
+    Кэшируется по тексту запроса и параметрам на COUNT_CACHE_TTL секунд:
+    фильтры меняются редко, а COUNT стоит столько же, сколько сама страница.
+    """
+    key = 'count:' + json.dumps([count_query, params], ensure_ascii=False, default=str)
+    total_count = cache.get(key)
+    if total_count is None:
+        total_count = conn.execute(count_query, params).fetchone()[0]
+        cache.set(key, total_count, timeout=COUNT_CACHE_TTL)
+    return total_count
+
 def get_delivery_costs(conn):
     """Получаем стоимость доставки по регионам"""
     costs = conn.execute('''
@@ -1158,7 +1645,7 @@ def api_order_export_supplier():
         conn = get_db_connection()
         
         # Получаем курсы валют
-        currency_rates = get_currency_rates(conn)
+        currency_rates = get_currency_rates()
         
         # Создаем DataFrame для экспорта
         export_data = []
@@ -1247,10 +1734,10 @@ def api_order_export_supplier_detailed():
     supplier_region = data.get('supplier_region', 'Китай')
     
     try:
-        conn = get_db_connection()
-        currency_rates = get_currency_rates(conn)
+        currency_rates = get_currency_rates()
         
         export_data = []
+        headers = None
         total_quantity = 0
         total_value_original = 0
         total_value_rub = 0
@@ -1261,7 +1748,13 @@ def api_order_export_supplier_detailed():
             if not region_data or region_data.get('price_original') is None:
                 continue
             
-            currency = region_data.get('currency', 'USD')
+            # Заголовки строим один раз по валюте первой позиции
+            if headers is None:
+                currency = region_data.get('currency', 'USD')
+                headers = ('Марка', 'Артикул', 'Название', 'Количество',
+                           f'Цена_({currency})', f'Сумма_({currency})',
+                           'Цена_руб', 'Сумма_руб', 'Поставщик', 'Вес_кг')
+            
             price_original = region_data.get('price_original')
             price_rub = region_data.get('price_rub')
             quantity = item.get('quantity', 0)
@@ -1275,43 +1768,30 @@ def api_order_export_supplier_detailed():
             total_value_original += item_value_original
             total_value_rub += item_value_rub if item_value_rub else 0
             
-            row = {
-                'Марка': item.get('brand', ''),
-                'Артикул': item.get('article', ''),
-                'Название': item.get('name', ''),
-                'Количество': quantity,
-                f'Цена_({currency})': round(price_original, 2),
-                f'Сумма_({currency})': round(item_value_original, 2),
-                'Цена_руб': round(price_rub, 2) if price_rub else '',
-                'Сумма_руб': round(item_value_rub, 2) if item_value_rub else '',
-                'Поставщик': supplier_name,
-                'Вес_кг': item.get('catalog_weight') or item.get('custom_weight')
-            }
-            
-            export_data.append(row)
-        
-        conn.close()
+            export_data.append((
+                item.get('brand', ''),
+                item.get('article', ''),
+                item.get('name', ''),
+                quantity,
+                round(price_original, 2),
+                round(item_value_original, 2),
+                round(price_rub, 2) if price_rub else '',
+                round(item_value_rub, 2) if item_value_rub else '',
+                supplier_name,
+                item.get('catalog_weight') or item.get('custom_weight')
+            ))
         
         if not export_data:
             return jsonify({'error': f'Нет данных по региону {supplier_region}'}), 400
         
         # Добавляем итоговую строку
-        if export_data:
-            export_data.append({
-                'Марка': 'ИТОГО:',
-                'Артикул': '',
-                'Название': '',
-                'Количество': total_quantity,
-                f'Цена_({currency})': '',
-                f'Сумма_({currency})': round(total_value_original, 2),
-                'Цена_руб': '',
-                'Сумма_руб': round(total_value_rub, 2),
-                'Поставщик': '',
-                'Вес_кг': ''
-            })
+        export_data.append((
+            'ИТОГО:', '', '', total_quantity, '',
+            round(total_value_original, 2), '', round(total_value_rub, 2), '', ''
+        ))
         
         # Создаем DataFrame
-        df = pd.DataFrame(export_data)
+        df = pd.DataFrame(export_data, columns=headers)
         
         output = BytesIO()
         
@@ -1366,10 +1846,10 @@ def api_order_export_specific_supplier():
     order_data = data.get('order_data', {})
     
     try:
-        conn = get_db_connection()
-        currency_rates = get_currency_rates(conn)
+        currency_rates = get_currency_rates()
         
         export_data = []
+        headers = None
         total_quantity = 0
         total_value_original = 0
         total_value_rub = 0
@@ -1381,7 +1861,13 @@ def api_order_export_specific_supplier():
             if not supplier_data or not supplier_data.get('has_data'):
                 continue
             
-            currency = supplier_data.get('currency', 'USD')
+            # Заголовки строим один раз по валюте первой позиции
+            if headers is None:
+                currency = supplier_data.get('currency', 'USD')
+                headers = ('Марка', 'Артикул', 'Название', 'Количество',
+                           f'Цена_({currency})', f'Сумма_({currency})',
+                           'Цена_руб', 'Сумма_руб', 'Поставщик', 'Вес_кг', 'Прибыль_%')
+            
             price_original = supplier_data.get('price_original')
             price_rub = supplier_data.get('price_rub')
             quantity = item.get('quantity', 0)
@@ -1395,45 +1881,31 @@ def api_order_export_specific_supplier():
             total_value_original += item_value_original
             total_value_rub += item_value_rub if item_value_rub else 0
             
-            row = {
-                'Марка': item.get('brand', ''),
-                'Артикул': item.get('article', ''),
-                'Название': item.get('name', ''),
-                'Количество': quantity,
-                f'Цена_({currency})': round(price_original, 2),
-                f'Сумма_({currency})': round(item_value_original, 2),
-                'Цена_руб': round(price_rub, 2) if price_rub else '',
-                'Сумма_руб': round(item_value_rub, 2) if item_value_rub else '',
-                'Поставщик': supplier_name,
-                'Вес_кг': item.get('catalog_weight') or item.get('custom_weight'),
-                'Прибыль_%': supplier_data.get('profit_percent', '')
-            }
-            
-            export_data.append(row)
-        
-        conn.close()
+            export_data.append((
+                item.get('brand', ''),
+                item.get('article', ''),
+                item.get('name', ''),
+                quantity,
+                round(price_original, 2),
+                round(item_value_original, 2),
+                round(price_rub, 2) if price_rub else '',
+                round(item_value_rub, 2) if item_value_rub else '',
+                supplier_name,
+                item.get('catalog_weight') or item.get('custom_weight'),
+                supplier_data.get('profit_percent', '')
+            ))
         
         if not export_data:
             return jsonify({'error': 'Нет данных по выбранному поставщику'}), 400
         
         # Добавляем итоговую строку
-        if export_data:
-            export_data.append({
-                'Марка': 'ИТОГО:',
-                'Артикул': '',
-                'Название': '',
-                'Количество': total_quantity,
-                f'Цена_({currency})': '',
-                f'Сумма_({currency})': round(total_value_original, 2),
-                'Цена_руб': '',
-                'Сумма_руб': round(total_value_rub, 2),
-                'Поставщик': '',
-                'Вес_кг': '',
-                'Прибыль_%': ''
-            })
+        export_data.append((
+            'ИТОГО:', '', '', total_quantity, '',
+            round(total_value_original, 2), '', round(total_value_rub, 2), '', '', ''
+        ))
         
         # Создаем DataFrame
-        df = pd.DataFrame(export_data)
+        df = pd.DataFrame(export_data, columns=headers)
         
         output = BytesIO()
         
@@ -1526,6 +1998,9 @@ def find_best_region(regions_data, sale_price):
             data['is_high_profit'] = (profit > 15)  # Прибыль более 15%
             
 
+# Размер пачки при сохранении позиций заказа
+ORDER_SAVE_BATCH_SIZE = 500
+
 @app.route('/api/order/save', methods=['POST'])
 def api_order_save():
     """API для сохранения заказа и обновления данных"""
@@ -1540,6 +2015,9 @@ def api_order_save():
     conn = get_db_connection()
     
     try:
+        # Берем блокировку на запись сразу, чтобы весь заказ ушел одной транзакцией
+        conn.execute('BEGIN IMMEDIATE')
+        
         # Сохраняем заказ
         cursor = conn.execute('''
             INSERT INTO purchase_orders (order_name, order_date, coefficient)
@@ -1547,8 +2025,11 @@ def api_order_save():
         ''', (order_name, coefficient))
         order_id = cursor.lastrowid
         
-        # Сохраняем ВСЕ позиции заказа
+        # Сохраняем ВСЕ позиции заказа пачками
         saved_count = 0
+        item_rows = []
+        weight_rows = []
+        price_rows = []
         for item in order_items:
             # Находим part_id для детали
             part_id = find_part_id(item.get('brand'), item.get('article'), conn)
@@ -1563,29 +2044,25 @@ def api_order_save():
             update_catalog = item.get('update_catalog', False)
             update_price = item.get('update_price', False)
             
-            # Сохраняем позицию заказа
-            conn.execute('''
-                INSERT INTO order_items (order_id, part_id, quantity, custom_weight, custom_sale_price)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (order_id, part_id, quantity, custom_weight, custom_sale_price))
+            # Позиция заказа
+            item_rows.append((order_id, part_id, quantity, custom_weight, custom_sale_price))
             saved_count += 1
             
             # Обновляем каталог если нужно
             if update_catalog and custom_weight is not None:
-                conn.execute('''
-                    UPDATE parts_catalog 
-                    SET weight = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (custom_weight, part_id))
+                weight_rows.append((custom_weight, part_id))
             
             # Обновляем цену продажи если нужно
             if update_price and custom_sale_price is not None:
-                conn.execute('''
-                    INSERT INTO expected_sale_prices (part_id, price_rub, effective_date)
-                    VALUES (?, ?, DATE('now'))
-                ''', (part_id, custom_sale_price))
+                price_rows.append((part_id, custom_sale_price))
+            
+            if len(item_rows) >= ORDER_SAVE_BATCH_SIZE:
+                save_order_batch(conn, item_rows, weight_rows, price_rows)
         
+        save_order_batch(conn, item_rows, weight_rows, price_rows)
         conn.commit()
+        cache.delete('orders_list')
+        cache.delete('expected_prices_count')
         
         return jsonify({
             'success': True,
@@ -1600,6 +2077,29 @@ def api_order_save():
     finally:
         conn.close()
 
+def save_order_batch(conn, item_rows, weight_rows, price_rows):
+    """Записывает накопленную пачку позиций заказа и очищает списки"""
+    if item_rows:
+        conn.executemany('''
+            INSERT INTO order_items (order_id, part_id, quantity, custom_weight, custom_sale_price)
+            VALUES (?, ?, ?, ?, ?)
+        ''', item_rows)
+    if weight_rows:
+        conn.executemany('''
+            UPDATE parts_catalog 
+            SET weight = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', weight_rows)
+    if price_rows:
+        conn.executemany('''
+            INSERT INTO expected_sale_prices (part_id, price_rub, effective_date)
+            VALUES (?, ?, DATE('now'))
+        ''', price_rows)
+    
+    item_rows.clear()
+    weight_rows.clear()
+    price_rows.clear()
+
 def find_part_id(brand_name, article, conn):
     """Находит part_id по бренду и артикулу"""
     if not brand_name or not article:
@@ -1615,6 +2115,7 @@ def find_part_id(brand_name, article, conn):
     return part_data['id'] if part_data else None
 
 @app.route('/api/orders/list')
+@cache.cached(key_prefix='orders_list')
 def api_orders_list():
     """API для получения списка сохраненных заказов"""
     conn = get_db_connection()
@@ -1636,7 +2137,7 @@ def api_orders_list():
         
         return jsonify({
             'success': True,
-            'orders': [dict(order) for order in orders]
+            'orders': orders
         })
         
     except Exception as e:
@@ -1650,81 +2151,85 @@ def api_order_load(order_id):
     conn = get_db_connection()
     
     try:
-        # Получаем основную информацию о заказе
-        order_info = conn.execute('''
-            SELECT * FROM purchase_orders WHERE id = ?
-        ''', (order_id,)).fetchone()
+        # Последние 5 записей статистики для всех позиций заказа
+        stats_rows = conn.execute('''
+            SELECT part_id, data_type, quantity
+            FROM (
+                SELECT 
+                    ss.part_id,
+                    ss.data_type,
+                    ss.quantity,
+                    ROW_NUMBER() OVER (PARTITION BY ss.part_id ORDER BY ss.period DESC) as rn
+                FROM sales_statistics ss
+                WHERE ss.part_id IN (SELECT part_id FROM order_items WHERE order_id = ?)
+            )
+            WHERE rn <= 5
+            ORDER BY part_id, rn
+        ''', (order_id,)).fetchall()
+        stats_by_part = defaultdict(list)
+        for row in stats_rows:
+            stats_by_part[row['part_id']].append(row)
         
-        if not order_info:
-            return jsonify({'error': 'Заказ не найден'}), 404
+        # Статистику форматируем в Python (format_statistics), остальное собирает SQLite
+        statistics = {str(part_id): format_statistics(rows) for part_id, rows in stats_by_part.items()}
         
-        # Получаем позиции заказа
-        order_items = conn.execute('''
+        # Ответ целиком формируется через json_object / json_group_array
+        result = conn.execute('''
+            WITH LatestSalePrices AS (
+                SELECT part_id, price_rub, effective_date
+                FROM (
+                    SELECT 
+                        part_id,
+                        price_rub,
+                        effective_date,
+                        ROW_NUMBER() OVER (PARTITION BY part_id ORDER BY effective_date DESC) as rn
+                    FROM expected_sale_prices
+                    WHERE part_id IN (SELECT part_id FROM order_items WHERE order_id = :order_id)
+                )
+                WHERE rn = 1
+            ),
+            Items AS (
+                SELECT json_object(
+                    'brand', pc.brand_name,
+                    'article', pc.main_article,
+                    'name', pc.name_ru,
+                    'catalog_weight', pc.weight,
+                    'custom_weight', oi.custom_weight,
+                    'quantity', oi.quantity,
+                    'sale_price', lsp.price_rub,
+                    'sale_price_date', lsp.effective_date,
+                    'custom_sale_price', oi.custom_sale_price,
+                    'statistics', st.value,
+                    'part_id', oi.part_id
+                ) as item
+                FROM order_items oi
+                JOIN parts_catalog pc ON oi.part_id = pc.id
+                LEFT JOIN LatestSalePrices lsp ON lsp.part_id = oi.part_id
+                LEFT JOIN json_each(:statistics) st ON st.key = CAST(oi.part_id AS TEXT)
+                WHERE oi.order_id = :order_id
+                ORDER BY oi.id
+            )
             SELECT 
-                oi.*,
-                b.name as brand_name,
-                pc.main_article,
-                pc.name_ru,
-                pc.weight as catalog_weight
-            FROM order_items oi
-            JOIN parts_catalog pc ON oi.part_id = pc.id
-            JOIN brands b ON pc.brand_id = b.id
-            WHERE oi.order_id = ?
-        ''', (order_id,)).fetchall()
+                json_object(
+                    'success', json('true'),
+                    'order_data', json_object(
+                        'name', po.order_name || ' (загружен)',
+                        'items', json((SELECT json_group_array(json(item)) FROM Items)),
+                        'coefficient', po.coefficient,
+                        'original_order_id', po.id
+                    )
+                ) as response_json,
+                (SELECT COUNT(*) FROM Items) as items_count
+            FROM purchase_orders po
+            WHERE po.id = :order_id
+        ''', {'order_id': order_id, 'statistics': json.dumps(statistics)}).fetchone()
         
-        print(f"DEBUG: Загружен заказ {order_id}, позиций: {len(order_items)}")  # Отладочная информация
+        if not result:
+            return jsonify({'error': 'Заказ не найден'}), 404
         
-        # Формируем данные для фронтенда
-        items_data = []
-        for item in order_items:
-            # Ищем актуальную цену продажи
-            sale_price_data = conn.execute('''
-                SELECT price_rub, effective_date 
-                FROM expected_sale_prices 
-                WHERE part_id = ? 
-                ORDER BY effective_date DESC 
-                LIMIT 1
-            ''', (item['part_id'],)).fetchone()
-
-            # Ищем статистику
-            stats_data = conn.execute('''
-                SELECT ss.data_type, ss.quantity
-                FROM sales_statistics ss
-                WHERE part_id= ?
-                ORDER BY ss.period DESC
-                LIMIT 5
-            ''', (item['part_id'],)).fetchall()
-            
-            # Формируем статистику
-            statistics = format_statistics(stats_data)
-
-            
-            item_data = {
-                'brand': item['brand_name'],
-                'article': item['main_article'],
-                'name': item['name_ru'],
-                'catalog_weight': item['catalog_weight'],
-                'custom_weight': item['custom_weight'],
-                'quantity': item['quantity'],
-                'sale_price': sale_price_data['price_rub'] if sale_price_data else None,
-                'sale_price_date': sale_price_data['effective_date'] if sale_price_data else None,
-                'custom_sale_price': item['custom_sale_price'],
-                'statistics': statistics,
-                'part_id': item['part_id']
-            }
-            
-            items_data.append(item_data)
-            print(f"DEBUG: Позиция - {item['brand_name']} {item['main_article']}")  # Отладочная информация
+        print(f"DEBUG: Загружен заказ {order_id}, позиций: {result['items_count']}")  # Отладочная информация
         
-        return jsonify({
-            'success': True,
-            'order_data': {
-                'name': order_info['order_name'] + ' (загружен)',
-                'items': items_data,
-                'coefficient': order_info['coefficient'],
-                'original_order_id': order_id
-            }
-        })
+        return Response(result['response_json'], mimetype='application/json')
         
     except Exception as e:
         print(f"DEBUG: Ошибка загрузки заказа {order_id}: {str(e)}")  # Отладочная информация
@@ -1745,22 +2250,20 @@ def api_order_find_part():
     conn = get_db_connection()
     
     try:
-        # Ищем деталь в каталоге
+        # Ищем деталь в каталоге вместе с актуальной ценой продажи (одним запросом;
+        # при промахе цена не запрашивается отдельно)
         part_data = conn.execute('''
-            SELECT pc.id, pc.main_article, pc.name_ru, pc.weight, b.name as brand_name
+            SELECT 
+                pc.id, 
+                pc.main_article, 
+                pc.name_ru, 
+                pc.weight, 
+                pc.brand_name,
+                lep.price_rub as sale_price,
+                lep.effective_date as sale_price_date
             FROM parts_catalog pc
-            JOIN brands b ON pc.brand_id = b.id
-            WHERE b.name = ? AND pc.main_article = ?
-        ''', (brand_name, article)).fetchone()
-        
-        # Ищем цену продажи
-        sale_price_data = conn.execute('''
-            SELECT esp.price_rub, effective_date
-            FROM expected_sale_prices esp
-            JOIN parts_catalog pc ON esp.part_id = pc.id
-            JOIN brands b ON pc.brand_id = b.id
-            WHERE b.name = ? AND pc.main_article = ?
-            ORDER BY esp.effective_date DESC
+            LEFT JOIN latest_expected_price lep ON lep.part_id = pc.id
+            WHERE pc.brand_name = ? AND pc.main_article = ?
             LIMIT 1
         ''', (brand_name, article)).fetchone()
         
@@ -1780,9 +2283,8 @@ def api_order_find_part():
                 'article': part_data['main_article'],
                 'name': part_data['name_ru'],
                 'weight': part_data['weight'],
-                'sale_price': sale_price_data['price_rub'] if sale_price_data else None,
-                'sale_price_date': sale_price_data['effective_date'] if sale_price_data else None,
-
+                'sale_price': part_data['sale_price'],
+                'sale_price_date': part_data['sale_price_date'],
             }
         })
         
@@ -1792,6 +2294,9 @@ def api_order_find_part():
         conn.close()
         
         
+# Регионы в выгрузке заказа (ключи из calculate_region_prices)
+ORDER_EXPORT_REGIONS = ['китай', 'оаэ', 'япония']
+
 @app.route('/api/order/export', methods=['POST'])
 def api_order_export():
     """API для экспорта заказа в Excel с датами цен"""
@@ -1799,81 +2304,87 @@ def api_order_export():
     order_data = data.get('order_data', {})
     
     try:
-        # Создаем DataFrame для экспорта
-        export_data = []
+        now = datetime.now()
+        
+        # Заголовки колонок
+        headers = ['Марка', 'Артикул', 'Название', 'Вес_кг', 'Количество',
+                   'Цена_продажи_руб', 'Дата_цены_продажи', 'Статистика']
+        for region_name in ORDER_EXPORT_REGIONS:
+            headers += [f'Цена_{region_name}_руб', f'Прибыль_{region_name}_%', f'Поставщик_{region_name}']
+        
+        # Пишем Excel потоково, строка за строкой
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Заказ')
+        
+        # Настраиваем ширину колонок (в потоковом режиме - до записи строк)
+        column_widths = {
+            'A': 15, 'B': 20, 'C': 30, 'D': 10, 'E': 12, 'F': 15, 'G': 20, 'H': 15,
+            'I': 15, 'J': 15, 'K': 15, 'L': 15, 'M': 15, 'N': 15, 'O': 20, 'P': 20, 'Q': 20
+        }
+        
+        for col, width in column_widths.items():
+            worksheet.column_dimensions[col].width = width
+        
+        # Добавляем заголовки
+        worksheet.append([f"Заказ: {order_data.get('name', 'Без названия')}"])
+        worksheet.append([f"Коэффициент: {order_data.get('coefficient', 0.835)}"])
+        worksheet.append([f"Дата экспорта: {now.strftime('%d.%m.%Y %H:%M')}"])
+        worksheet.append(["Цветовая маркировка: 🔵 - цена старше 2 недель, 🔴 - старше месяца"])
+        
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(worksheet, value=header)
+            cell.font = Font(bold=True)
+            header_cells.append(cell)
+        worksheet.append(header_cells)
         
         for item in order_data.get('items', []):
             # Форматируем дату цены
             price_date = item.get('sale_price_date')
             if price_date:
                 try:
-                    price_date_str = datetime.strptime(price_date, '%Y-%m-%d').strftime('%d.%m.%Y')
-                    days_ago = (datetime.now() - datetime.strptime(price_date, '%Y-%m-%d')).days
-                    price_date_display = f"{price_date_str} ({days_ago} дн. назад)"
-                except:
+                    price_date_value = datetime.strptime(price_date, '%Y-%m-%d')
+                    days_ago = (now - price_date_value).days
+                    price_date_display = f"{price_date_value.strftime('%d.%m.%Y')} ({days_ago} дн. назад)"
+                except (TypeError, ValueError):
                     price_date_display = price_date
             else:
                 price_date_display = 'Нет данных'
             
-            row = {
-                'Марка': item.get('brand', ''),
-                'Артикул': item.get('article', ''),
-                'Название': item.get('name', ''),
-                'Вес_кг': item.get('catalog_weight') or item.get('custom_weight'),
-                'Количество': item.get('quantity', 0),
-                'Цена_продажи_руб': item.get('sale_price') or item.get('custom_sale_price'),
-                'Дата_цены_продажи': price_date_display,
-                'Статистика': item.get('statistics', '')
-            }
+            row = [
+                item.get('brand', ''),
+                item.get('article', ''),
+                item.get('name', ''),
+                item.get('catalog_weight') or item.get('custom_weight'),
+                item.get('quantity', 0),
+                item.get('sale_price') or item.get('custom_sale_price'),
+                price_date_display,
+                item.get('statistics', '')
+            ]
             
             # Добавляем данные по регионам
             regions = item.get('regions', {})
-            for region_name in ['китай', 'оаэ', 'япония']:
+            for region_name in ORDER_EXPORT_REGIONS:
                 region_data = regions.get(region_name, {})
-                row[f'Цена_{region_name}_руб'] = region_data.get('price_rub')
-                row[f'Прибыль_{region_name}_%'] = region_data.get('profit_percent')
-                row[f'Поставщик_{region_name}'] = region_data.get('supplier', '')
-            
-            export_data.append(row)
-        
-        # Создаем DataFrame
-        df = pd.DataFrame(export_data)
-        
-        # Создаем Excel файл в памяти
-        output = BytesIO()
-        
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Заказ', index=False)
-            
-            # Получаем workbook и worksheet для форматирования
-            workbook = writer.book
-            worksheet = writer.sheets['Заказ']
-            
-            # Настраиваем ширину колонок
-            column_widths = {
-                'A': 15, 'B': 20, 'C': 30, 'D': 10, 'E': 12, 'F': 15, 'G': 20, 'H': 15,
-                'I': 15, 'J': 15, 'K': 15, 'L': 15, 'M': 15, 'N': 15, 'O': 20, 'P': 20, 'Q': 20
-            }
-            
-            for col, width in column_widths.items():
-                worksheet.column_dimensions[col].width = width
+                row += [
+                    region_data.get('price_rub'),
+                    region_data.get('profit_percent'),
+                    region_data.get('supplier', '')
+                ]
             
-            # Добавляем заголовки
-            worksheet.insert_rows(1, 4)
-            worksheet['A1'] = f"Заказ: {order_data.get('name', 'Без названия')}"
-            worksheet['A2'] = f"Коэффициент: {order_data.get('coefficient', 0.835)}"
-            worksheet['A3'] = f"Дата экспорта: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            worksheet['A4'] = "Цветовая маркировка: 🔵 - цена старше 2 недель, 🔴 - старше месяца"
+            worksheet.append(row)
         
-        output.seek(0)
+        # Пишем книгу во временный файл: сервер отдаст его без копии в памяти
+        export_file = save_workbook_to_temp_file(workbook)
         
         # Возвращаем файл
-        filename = f"заказ_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+        filename = f"заказ_{now.strftime('%Y%m%d_%H%M')}.xlsx"
         return send_file(
-            output,
+            export_file,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
-            download_name=filename
+            download_name=filename,
+            conditional=True
         )
         
     except Exception as e:
@@ -1888,36 +2399,42 @@ def manage_suppliers():
     if request.method == 'POST':
         action = request.form.get('action')
         
-        if action == 'add':
-            name = request.form.get('name').strip()
-            region_id = request.form.get('region_id')
-            currency = request.form.get('currency', 'RUB')
-            contact_info = request.form.get('contact_info', '')
+        # Изменение - одна транзакция (with conn фиксирует ее один раз),
+        # затем редирект на GET вместо повторной выборки в этом же запросе
+        with conn:
+            if action == 'add':
+                name = request.form.get('name').strip()
+                region_id = request.form.get('region_id')
+                currency = request.form.get('currency', 'RUB')
+                contact_info = request.form.get('contact_info', '')
+                
+                if name and region_id:
+                    try:
+                        conn.execute(
+                            'INSERT INTO suppliers (name, region_id, currency, contact_info) VALUES (?, ?, ?, ?)',
+                            (name, region_id, currency, contact_info)
+                        )
+                        flash(f'Поставщик "{name}" добавлен!', 'success')
+                    except sqlite3.IntegrityError:
+                        flash(f'Поставщик "{name}" уже существует!', 'error')
             
-            if name and region_id:
-                try:
-                    conn.execute(
-                        'INSERT INTO suppliers (name, region_id, currency, contact_info) VALUES (?, ?, ?, ?)',
-                        (name, region_id, currency, contact_info)
-                    )
-                    conn.commit()
-                    flash(f'Поставщик "{name}" добавлен!', 'success')
-                except sqlite3.IntegrityError:
-                    flash(f'Поставщик "{name}" уже существует!', 'error')
+            elif action == 'delete':
+                supplier_id = request.form.get('supplier_id')
+                has_price_lists = conn.execute(
+                    'SELECT COUNT(*) FROM price_lists WHERE supplier_id = ?', 
+                    (supplier_id,)
+                ).fetchone()[0]
+                
+                if has_price_lists > 0:
+                    flash('Нельзя удалить поставщика, у которого есть прайс-листы!', 'error')
+                else:
+                    conn.execute('DELETE FROM suppliers WHERE id = ?', (supplier_id,))
+                    flash('Поставщик удален!', 'success')
         
-        elif action == 'delete':
-            supplier_id = request.form.get('supplier_id')
-            has_price_lists = conn.execute(
-                'SELECT COUNT(*) FROM price_lists WHERE supplier_id = ?', 
-                (supplier_id,)
-            ).fetchone()[0]
-            
-            if has_price_lists > 0:
-                flash('Нельзя удалить поставщика, у которого есть прайс-листы!', 'error')
-            else:
-                conn.execute('DELETE FROM suppliers WHERE id = ?', (supplier_id,))
-                conn.commit()
-                flash('Поставщик удален!', 'success')
+        conn.close()
+        cache.delete('suppliers_list')
+        cache.delete_memoized(check_currency_rates)
+        return redirect(url_for('manage_suppliers'))
     
     suppliers = conn.execute('''
         SELECT s.*, r.name as region_name 
@@ -1962,6 +2479,7 @@ def toggle_price_list(price_list_id):
     )
     conn.commit()
     conn.close()
+    invalidate_price_caches()
     
     return jsonify({'success': True, 'new_state': new_state})
 
@@ -2005,7 +2523,7 @@ def price_list_analysis(price_list_id):
         -- Цены из анализируемого прайс-листа
         SELECT 
             pc.id as part_id,
-            b.name as brand,
+            pc.brand_name as brand,
             pc.main_article,
             pc.name_ru,
             p.price as current_price,
@@ -2014,11 +2532,10 @@ def price_list_analysis(price_list_id):
             s.currency as supplier_currency,
             s.region_id
         FROM parts_catalog pc
-        JOIN brands b ON pc.brand_id = b.id
         JOIN prices p ON p.part_id = pc.id
         JOIN price_lists pl ON p.price_list_id = pl.id
         JOIN suppliers s ON pl.supplier_id = s.id
-        WHERE pl.id = ?
+        WHERE pl.id = :price_list_id
     ),
     PreviousPrices AS (
         -- Предыдущие цены от этого же поставщика
@@ -2029,8 +2546,8 @@ def price_list_analysis(price_list_id):
             ROW_NUMBER() OVER (PARTITION BY p.part_id ORDER BY pl.upload_date DESC) as rn
         FROM prices p
         JOIN price_lists pl ON p.price_list_id = pl.id
-        WHERE pl.supplier_id = (SELECT supplier_id FROM CurrentPrices LIMIT 1)
-          AND pl.upload_date < (SELECT upload_date FROM price_lists WHERE id = ?)
+        WHERE pl.supplier_id = :supplier_id
+          AND pl.upload_date < :upload_date
           AND pl.is_active = 1
     ),
     RegionalMarketPrices AS (
@@ -2040,16 +2557,7 @@ def price_list_analysis(price_list_id):
             p.price as market_price_original,
             s.currency as market_currency,
             -- Конвертируем в рубли для сравнения
-            CASE 
-                WHEN s.currency = 'RUB' THEN p.price
-                ELSE p.price * (
-                    SELECT rate_to_rub 
-                    FROM currency_rates 
-                    WHERE currency_code = s.currency 
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                )
-            END as market_price_rub,
+            p.price * lr.value as market_price_rub,
             s.name as market_supplier_name,
             pl.upload_date as market_date,
             ROW_NUMBER() OVER (PARTITION BY pc.id, s.id ORDER BY pl.upload_date DESC) as rn_supplier
@@ -2057,10 +2565,11 @@ def price_list_analysis(price_list_id):
         JOIN prices p ON p.part_id = pc.id
         JOIN price_lists pl ON p.price_list_id = pl.id
         JOIN suppliers s ON pl.supplier_id = s.id
+        LEFT JOIN json_each(:rates) lr ON lr.key = s.currency
         WHERE pl.is_active = 1
-          AND pl.upload_date >= DATE('now', '-1300 days')  -- !!!
-          AND s.region_id = (SELECT region_id FROM CurrentPrices LIMIT 1)  -- Только тот же регион!
-          AND s.id != (SELECT supplier_id FROM CurrentPrices LIMIT 1)      -- Исключаем текущего поставщика
+          AND pl.upload_date >= :cutoff_date
+          AND s.region_id = :region_id  -- Только тот же регион!
+          AND s.id != :supplier_id      -- Исключаем текущего поставщика
     ),
     BestRegionalPrices AS (
         -- Находим лучшую цену в регионе
@@ -2105,51 +2614,62 @@ def price_list_analysis(price_list_id):
         END as change_vs_previous_percent,
         CASE 
             WHEN rpd.best_regional_price_rub IS NOT NULL AND rpd.best_regional_price_rub > 0 
-            THEN ROUND(((
-                CASE 
-                    WHEN cp.supplier_currency = 'RUB' THEN cp.current_price
-                    ELSE cp.current_price * (
-                        SELECT rate_to_rub 
-                        FROM currency_rates 
-                        WHERE currency_code = cp.supplier_currency 
-                        ORDER BY created_at DESC 
-                        LIMIT 1
-                    )
-                END
-            ) - rpd.best_regional_price_rub) / rpd.best_regional_price_rub * 100, 2)
+            THEN ROUND((cp.current_price * lr.value - rpd.best_regional_price_rub) / rpd.best_regional_price_rub * 100, 2)
             ELSE NULL 
         END as change_vs_regional_percent
     FROM CurrentPrices cp
+    LEFT JOIN json_each(:rates) lr ON lr.key = cp.supplier_currency
     LEFT JOIN PreviousPrices pp ON cp.part_id = pp.part_id AND pp.rn = 1
     LEFT JOIN RegionalPriceDetails rpd ON cp.part_id = rpd.part_id
     ORDER BY cp.brand, cp.main_article
     '''
     
-    analysis_data = conn.execute(query, (price_list_id, price_list_id)).fetchall()
+    # Поставщик, регион и граница свежести рыночных цен - константы запроса
+    cutoff_date = (datetime.now() - timedelta(days=MARKET_PRICE_WINDOW_DAYS)).strftime('%Y-%m-%d')
+    # Курсы берем из кэша; рубль всегда 1, поэтому пересчет в SQL - одно умножение
+    rates = dict(get_currency_rates(), RUB=1.0)
+    analysis_data = conn.execute(query, {
+        'price_list_id': price_list_id,
+        'supplier_id': price_list_info['supplier_id'],
+        'region_id': price_list_info['region_id'],
+        'upload_date': price_list_info['upload_date'],
+        'cutoff_date': cutoff_date,
+        'rates': json.dumps(rates)
+    }).fetchall()
+    
+    # Статистика по прайс-листу (один проход по строкам)
+    price_increased = price_decreased = better_than_regional = worse_than_regional = 0
+    for r in analysis_data:
+        change_previous = r['change_vs_previous_percent']
+        if change_previous:
+            if change_previous > 0:
+                price_increased += 1
+            else:
+                price_decreased += 1
+        
+        change_regional = r['change_vs_regional_percent']
+        if change_regional:
+            if change_regional > 0:
+                worse_than_regional += 1
+            else:
+                better_than_regional += 1
     
-    # Статистика по прайс-листу
     stats = {
         'total_items': len(analysis_data),
-        'price_increased': len([r for r in analysis_data if r['change_vs_previous_percent'] and r['change_vs_previous_percent'] > 0]),
-        'price_decreased': len([r for r in analysis_data if r['change_vs_previous_percent'] and r['change_vs_previous_percent'] < 0]),
-        'better_than_regional': len([r for r in analysis_data if r['change_vs_regional_percent'] and r['change_vs_regional_percent'] <= 0]),
-        'worse_than_regional': len([r for r in analysis_data if r['change_vs_regional_percent'] and r['change_vs_regional_percent'] > 0]),
+        'price_increased': price_increased,
+        'price_decreased': price_decreased,
+        'better_than_regional': better_than_regional,
+        'worse_than_regional': worse_than_regional,
         'region_name': price_list_info['region_name']
     }
     
-    # Получаем актуальные курсы валют для отображения
-    currency_rates_data = conn.execute('''
-        SELECT currency_code, rate_to_rub 
-        FROM currency_rates 
-        ORDER BY created_at DESC
-    ''').fetchall()
-
-    currency_rates = {rate['currency_code']: rate['rate_to_rub'] for rate in currency_rates_data}
-
     conn.close()
 
+    # Получаем актуальные курсы валют для отображения
+    currency_rates = get_currency_rates()
+
     return render_template('price_list_analysis.html', 
-                         price_list=dict(price_list_info),
+                         price_list=price_list_info,
                          analysis_data=analysis_data,
                          stats=stats,
                          currency_rates=currency_rates)  # Добавляем курсы валют
@@ -2180,104 +2700,115 @@ def upload_file():
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             file.save(filepath)
 
-            # Читаем Excel
-            df = pd.read_excel(filepath)
-            
-            # Определяем колонки
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower: column_mapping[col] = 'article'
-                elif 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'название' in col_lower or 'наименование' in col_lower: column_mapping[col] = 'name'
-                elif 'цена' in col_lower: column_mapping[col] = 'price'
-                elif 'вес' in col_lower: column_mapping[col] = 'weight'
-            
-            df = df.rename(columns=column_mapping)
+            # Читаем Excel: только распознанные колонки
+            df = read_excel_columns(filepath, PRICE_LIST_COLUMN_RULES)
             
             # Очистка данных
             if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
+                df['article'] = normalize_articles(df['article'])
             if 'brand' in df.columns:
                 df['brand'] = df['brand'].fillna('').astype(str).str.strip()
             
             df = df.dropna(subset=['article', 'price'])
             
-            conn = get_db_connection()
-            
-            # Создаем запись о прайс-листе
-            cursor = conn.execute(
-                'INSERT INTO price_lists (supplier_id, upload_date, file_name) VALUES (?, ?, ?)',
-                (supplier_id, upload_date, filename)
-            )
-            price_list_id = cursor.lastrowid
+            if 'brand' not in df.columns:
+                df['brand'] = ''
+            for col in ('name', 'weight'):
+                if col not in df.columns:
+                    df[col] = None
             
-            # Обрабатываем каждую строку
-            added_count = 0
-            updated_count = 0
-            new_brands = set()  # Для отслеживания новых брендов
+            conn = get_db_connection()
             
-            for _, row in df.iterrows():
-                article = row.get('article', '')
-                brand_name = row.get('brand', '')
-                name = row.get('name', '')
-                weight = row.get('weight')
-                price = row.get('price')
+            try:
+                # Вся загрузка идет одной транзакцией
+                conn.execute('BEGIN IMMEDIATE')
                 
-                if not article or not brand_name:
-                    continue
+                # Создаем запись о прайс-листе
+                cursor = conn.execute(INSERT_PRICE_LIST_SQL, (supplier_id, upload_date, filename))
+                price_list_id = cursor.lastrowid
                 
-                # Нормализуем название для поиска (верхний регистр, без лишних пробелов)
-                normalized_name = brand_name.upper().strip()
-                # Ищем бренд с учетом синонимов и регистра
-                brand_id = find_brand_by_name(normalized_name, conn)
-                if not brand_id:
-                    new_brands.add(brand_name)
-
-                # Находим или создаем бренд
-                brand_id = get_or_create_brand(brand_name, conn)
+                added_count = 0
+                updated_count = 0
+                new_brands = set()  # Для отслеживания новых брендов
                 
-                # Ищем деталь в каталоге
-                part = conn.execute(
-                    '''SELECT * FROM parts_catalog 
-                    WHERE brand_id = ? AND (main_article = ? OR additional_article = ?)''',
-                    (brand_id, article, article)
-                ).fetchone()
+                # Берем только строки с артикулом и брендом
+                df = df[(df['article'] != '') & (df['brand'] != '')].copy()
                 
-                if part:
-                    part_id = part['id']
-                    # Обновляем данные если они пустые
-                    update_data = {}
-                    if not part['name_ru'] and name:
-                        update_data['name_ru'] = name
-                    if not part['weight'] and weight:
-                        update_data['weight'] = weight
+                # Сопоставляем бренды всего файла по словарю брендов
+                brand_ids = dict(get_brand_map())
+                df['brand_norm'] = df['brand'].str.upper().str.strip()
+                unknown = df[~df['brand_norm'].isin(brand_ids.keys())]
+                new_brands.update(unknown['brand'])
+                for brand_norm, brand_name in unknown.drop_duplicates('brand_norm')[['brand_norm', 'brand']].itertuples(index=False):
+                    brand_ids[brand_norm] = get_or_create_brand(brand_name, conn)
+                df['brand_id'] = df['brand_norm'].map(brand_ids).astype(int)
+                
+                # Детали этих брендов из каталога, по основному и дополнительному артикулу
+                parts = load_parts_by_brand(df['brand_id'].unique().tolist(), conn)
+                new_parts = {}
+                updated_parts = {}
+                price_rows = []
+                
+                for article, brand_id, name, weight, price in df[['article', 'brand_id', 'name', 'weight', 'price']].itertuples(index=False, name=None):
+                    name = None if pd.isna(name) or name == '' else name
+                    weight = None if pd.isna(weight) else weight
+                    key = (brand_id, article)
+                    part = parts.get(key)
                     
-                    if update_data:
-                        set_clause = ', '.join([f"{k} = ?" for k in update_data])
-                        values = list(update_data.values()) + [part_id]
-                        conn.execute(
-                            f'UPDATE parts_catalog SET {set_clause}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                            values
-                        )
-                        updated_count += 1
-                else:
-                    # Создаем новую запись
-                    cursor = conn.execute(
-                        'INSERT INTO parts_catalog (brand_id, main_article, name_ru, weight) VALUES (?, ?, ?, ?)',
-                        (brand_id, article, name, weight)
+                    if part is None:
+                        # Новая деталь, создается одна на пару (бренд, артикул)
+                        part = {'id': None, 'name_ru': name, 'weight': weight}
+                        parts[key] = new_parts[key] = part
+                    elif part['id'] is None:
+                        # Повтор новой детали в файле - дополняем пустые поля
+                        part['name_ru'] = part['name_ru'] or name
+                        part['weight'] = part['weight'] or weight
+                    else:
+                        # Обновляем данные если они пустые
+                        if not part['name_ru'] and name:
+                            part['name_ru'] = name
+                            updated_parts[part['id']] = part
+                        if not part['weight'] and weight:
+                            part['weight'] = weight
+                            updated_parts[part['id']] = part
+                    
+                    price_rows.append((key, price))
+                
+                if updated_parts:
+                    conn.executemany(
+                        UPDATE_PART_DETAILS_SQL,
+                        [(part['name_ru'], part['weight'], part_id) for part_id, part in updated_parts.items()]
                     )
-                    part_id = cursor.lastrowid
-                    added_count += 1
+                    updated_count = len(updated_parts)
                 
-                # Сохраняем цену
-                conn.execute(
-                    'INSERT INTO prices (price_list_id, part_id, price) VALUES (?, ?, ?)',
-                    (price_list_id, part_id, price)
+                if new_parts:
+                    # Под блокировкой записи все id больше текущего максимума - наши
+                    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM parts_catalog').fetchone()[0]
+                    conn.executemany(
+                        INSERT_PART_SQL,
+                        [(brand_id, article, part['name_ru'], part['weight'])
+                         for (brand_id, article), part in new_parts.items()]
+                    )
+                    for row in conn.execute(SELECT_NEW_PARTS_SQL, (last_id,)):
+                        new_parts[(row['brand_id'], row['main_article'])]['id'] = row['id']
+                    added_count = len(new_parts)
+                
+                # Сохраняем цены
+                conn.executemany(
+                    INSERT_PRICE_SQL,
+                    [(price_list_id, parts[key]['id'], price) for key, price in price_rows]
                 )
+                
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
             
-            conn.commit()
-            conn.close()
+            invalidate_price_caches()
+            if new_brands:
+                invalidate_brand_map()
             
             # Формируем сообщение с информацией о новых брендах
             message_parts = [
@@ -2319,6 +2850,12 @@ def api_expected_prices():
     per_page = request.args.get('per_page', 50, type=int)
     offset = (page - 1) * per_page
     
+    # Курсорная пагинация: after_id (пустой для первой страницы) + after_brand, after_article
+    keyset = 'after_id' in request.args
+    after_brand = request.args.get('after_brand', '')
+    after_article = request.args.get('after_article', '')
+    after_id = request.args.get('after_id', type=int)
+    
     # Параметры фильтров
     brand_filter = request.args.get('brand', '').strip()
     article_filter = request.args.get('article', '').strip()
@@ -2332,61 +2869,50 @@ def api_expected_prices():
     
     # Базовый запрос
     base_query = '''
-        FROM expected_sale_prices p
-        JOIN parts_catalog pc ON p.part_id = pc.id
-        JOIN brands b ON pc.brand_id = b.id
-        WHERE p.id IN (
-            SELECT id FROM (
-                SELECT 
-                    id,
-                    part_id,
-                    ROW_NUMBER() OVER (PARTITION BY part_id ORDER BY effective_date DESC, created_at DESC) as rn
-                FROM expected_sale_prices
-            ) WHERE rn = 1
-        )
+        FROM latest_expected_price lep
+        JOIN parts_catalog pc ON pc.id = lep.part_id
+        JOIN expected_sale_prices p ON p.id = lep.price_id
+        WHERE 1 = 1
     '''
     
     params = []
     
     # Добавляем фильтры
     if brand_filter:
-        base_query += ' AND b.name LIKE ?'
+        base_query += ' AND pc.brand_name LIKE ?'
         params.append(f'%{brand_filter}%')
     
     if article_filter:
-        base_query += ' AND pc.main_article LIKE ?'
-        params.append(f'%{article_filter}%')
+        condition, condition_params = catalog_search_condition(article_filter, ('main_article',))
+        base_query += ' AND ' + condition
+        params.extend(condition_params)
     
     if name_filter:
-        base_query += ' AND pc.name_ru LIKE ?'
-        params.append(f'%{name_filter}%')
+        condition, condition_params = catalog_search_condition(name_filter, ('name_ru',))
+        base_query += ' AND ' + condition
+        params.extend(condition_params)
     
     if date_from:
-        base_query += ' AND p.effective_date >= ?'
+        base_query += ' AND lep.effective_date >= ?'
         params.append(date_from)
     
     if date_to:
-        base_query += ' AND p.effective_date <= ?'
+        base_query += ' AND lep.effective_date <= ?'
         params.append(date_to)
     
     if price_from is not None:
-        base_query += ' AND p.price_rub >= ?'
+        base_query += ' AND lep.price_rub >= ?'
         params.append(price_from)
     
     if price_to is not None:
-        base_query += ' AND p.price_rub <= ?'
+        base_query += ' AND lep.price_rub <= ?'
         params.append(price_to)
     
-    # Подсчет общего количества
-    count_query = 'SELECT COUNT(DISTINCT p.id) ' + base_query
-    total_count = conn.execute(count_query, params).fetchone()[0]
-    
-    # Запрос данных с пагинацией
-    data_query = '''
+    select_columns = '''
         SELECT 
             p.id,
             p.part_id,
-            b.name AS brand_name,
+            pc.brand_name,
             pc.main_article,
             pc.name_ru,
             p.price_rub,
@@ -2394,7 +2920,47 @@ def api_expected_prices():
             p.notes,
             p.created_at,
             p.updated_at
-    ''' + base_query + ' ORDER BY b.name, pc.main_article LIMIT ? OFFSET ?'
+    '''
+    
+    if keyset:
+        # Одна актуальная цена на деталь: курсор - (бренд, артикул, id детали)
+        keyset_query = select_columns + base_query
+        if after_id is not None:
+            keyset_query += ' AND (pc.brand_name, pc.main_article, pc.id) > (?, ?, ?)'
+            params.extend([after_brand, after_article, after_id])
+        keyset_query += ' ORDER BY pc.brand_name, pc.main_article, pc.id LIMIT ?'
+        params.append(per_page + 1)
+        
+        prices = conn.execute(keyset_query, params).fetchall()
+        conn.close()
+        
+        # Лишняя строка показывает, есть ли следующая страница
+        has_next = len(prices) > per_page
+        prices = prices[:per_page]
+        last = prices[-1] if has_next else None
+        return jsonify({
+            'prices': prices,
+            'has_next': has_next,
+            'next_cursor': {
+                'after_brand': last['brand_name'],
+                'after_article': last['main_article'],
+                'after_id': last['part_id']
+            } if last else None
+        })
+    
+    # Подсчет общего количества (одна строка на деталь, DISTINCT не нужен).
+    # Без фильтров число меняется только при записи цен - берем его из кэша
+    count_query = 'SELECT COUNT(*) ' + base_query
+    if params:
+        total_count = cached_count(conn, count_query, params)
+    else:
+        total_count = cache.get('expected_prices_count')
+        if total_count is None:
+            total_count = conn.execute(count_query).fetchone()[0]
+            cache.set('expected_prices_count', total_count)
+    
+    # Запрос данных с пагинацией
+    data_query = select_columns + base_query + ' ORDER BY pc.brand_name, pc.main_article LIMIT ? OFFSET ?'
     
     params.extend([per_page, offset])
     
@@ -2402,7 +2968,7 @@ def api_expected_prices():
     conn.close()
     
     return jsonify({
-        'prices': [dict(price) for price in prices],
+        'prices': prices,
         'total_count': total_count,
         'current_page': page,
         'total_pages': (total_count + per_page - 1) // per_page
@@ -2452,9 +3018,137 @@ def api_expected_prices_history(part_id):
     finally:
         conn.close()
 
+# ================== ФОНОВЫЕ ЗАГРУЗКИ ==================
+# Разбор Excel и запись в базу идут в фоне: запрос сразу получает 202 с номером задачи,
+# а воркер сервера освобождается для чтения. Писатель в SQLite один, поэтому и поток один -
+# загрузки идут по очереди, а не ждут блокировку базы
+upload_executor = ThreadPoolExecutor(max_workers=1)
+upload_jobs = {}  # job_id -> состояние задачи и итог загрузки
+upload_job_expiry = {}  # job_id -> время (time.time()), после которого итог завершенной задачи удаляется
+
+# Сколько хранится итог завершенной загрузки, если его никто не запросил, секунд
+UPLOAD_JOB_RESULT_TTL = 3600
+# Сколько итог еще отдается после первого опроса - на случай потерянного ответа, секунд
+UPLOAD_JOB_POLL_GRACE = 60
+
+def drop_expired_upload_jobs():
+    """Удаляет итоги завершенных загрузок, срок хранения которых истек"""
+    now = time.time()
+    for job_id, expires_at in list(upload_job_expiry.items()):
+        if expires_at <= now:
+            upload_job_expiry.pop(job_id, None)
+            upload_jobs.pop(job_id, None)
+
+def start_upload_job(file, process, *args):
+    """Сохраняет загруженный файл во временный и ставит его обработку в очередь"""
+    drop_expired_upload_jobs()
+    
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.filename)[1], delete=False) as tmp:
+        file.save(tmp)
+    
+    job_id = uuid.uuid4().hex
+    upload_jobs[job_id] = {'status': 'pending'}
+    upload_executor.submit(run_upload_job, job_id, process, tmp.name, *args)
+    
+    status_url = url_for('api_upload_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status_url': status_url}), 202, {'Location': status_url}
+
+def run_upload_job(job_id, process, filepath, *args):
+    """Выполняет загрузку в фоновом потоке и сохраняет итог в upload_jobs"""
+    upload_jobs[job_id] = {'status': 'running'}
+    try:
+        with app.app_context():
+            result = process(filepath, *args)
+        upload_jobs[job_id] = dict(result, status='done')
+    except Exception as e:
+        upload_jobs[job_id] = {'status': 'error', 'error': f'Ошибка обработки файла: {str(e)}'}
+    finally:
+        upload_job_expiry[job_id] = time.time() + UPLOAD_JOB_RESULT_TTL
+        os.remove(filepath)
+
+@app.route('/api/upload_status/<job_id>')
+def api_upload_status(job_id):
+    """API для опроса состояния фоновой загрузки; итог завершенной задачи отдается еще немного после первого опроса"""
+    drop_expired_upload_jobs()
+    
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    if job_id in upload_job_expiry:
+        upload_job_expiry[job_id] = min(upload_job_expiry[job_id], time.time() + UPLOAD_JOB_POLL_GRACE)
+    return jsonify(job)
+
+def process_expected_prices_upload(filepath):
+    """Разбирает файл ожидаемых цен и записывает их в базу; возвращает итог загрузки"""
+    # Читаем только распознанные колонки
+    df = read_excel_columns(filepath, EXPECTED_PRICES_COLUMN_RULES)
+
+    # Очистка данных
+    if 'article' in df.columns:
+        df['article'] = normalize_articles(df['article'])
+    if 'brand' in df.columns:
+        df['brand'] = df['brand'].fillna('').astype(str).str.strip()
+
+    df = df.dropna(subset=['article', 'price', 'brand'])
+
+    # Если дата не указана, используем текущую
+    if 'date' not in df.columns:
+        df['date'] = datetime.now().date()
+    if 'notes' not in df.columns:
+        df['notes'] = ''
+    df = df.fillna({'notes': ''})
+
+    conn = get_db_connection()
+
+    try:
+        # Вся загрузка идет одной транзакцией
+        conn.execute('BEGIN IMMEDIATE')
+        price_rows = []
+
+        # Детали каталога для всего файла находим или создаем пакетно
+        new_brands = set()
+        part_ids = resolve_part_ids(zip(df['brand'], df['article']), conn, new_brands)
+
+        for article, brand_name, price, effective_date, notes in df[
+            ['article', 'brand', 'price', 'date', 'notes']
+        ].itertuples(index=False, name=None):
+            if not article or not brand_name:
+                continue
+
+            part_id = part_ids.get((brand_name, article))
+            if not part_id:
+                continue
+
+            price_rows.append((part_id, price, effective_date, notes))
+
+        # Добавляем цены с привязкой к каталогу одним пакетом
+        conn.executemany('''
+            INSERT INTO expected_sale_prices 
+            (part_id, price_rub, effective_date, notes)
+            VALUES (?, ?, ?, ?)
+        ''', price_rows)
+        added_count = len(price_rows)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    cache.delete('expected_prices_count')
+    if new_brands:
+        invalidate_brand_map()
+
+    return {
+        'success': True,
+        'added': added_count,
+        'total': len(df)
+    }
+
 @app.route('/api/expected_prices/upload', methods=['POST'])
 def api_expected_prices_upload():
-    """API для загрузки цен из Excel"""
+    """API для загрузки цен из Excel: обработка идет в фоне, ответ 202 с адресом статуса"""
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
@@ -2463,74 +3157,7 @@ def api_expected_prices_upload():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and file.filename.endswith(('.xlsx', '.xls')):
-        try:
-            df = pd.read_excel(file)
-            
-            # Маппинг колонок
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower: column_mapping[col] = 'article'
-                elif 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'цена' in col_lower: column_mapping[col] = 'price'
-                elif 'дата' in col_lower: column_mapping[col] = 'date'
-                elif 'примеч' in col_lower: column_mapping[col] = 'notes'
-            
-            df = df.rename(columns=column_mapping)
-            
-            # Очистка данных
-            if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
-            if 'brand' in df.columns:
-                df['brand'] = df['brand'].fillna('').astype(str).str.strip()
-            
-            df = df.dropna(subset=['article', 'price', 'brand'])
-            
-            # Если дата не указана, используем текущую
-            if 'date' not in df.columns:
-                df['date'] = datetime.now().date()
-            
-            conn = get_db_connection()
-            added_count = 0
-            new_brands = set()
-            new_parts = set()
-            
-            for _, row in df.iterrows():
-                article = row.get('article', '')
-                brand_name = row.get('brand', '')
-                price = row.get('price')
-                effective_date = row.get('date', datetime.now().date())
-                notes = row.get('notes', '')
-                
-                if not article or not brand_name:
-                    continue
-                
-                # НАХОДИМ ИЛИ СОЗДАЕМ ДЕТАЛЬ В КАТАЛОГЕ
-                part_id = get_or_create_part_in_catalog(brand_name, article, conn)
-                
-                if not part_id:
-                    continue
-                
-                # Добавляем цену с привязкой к каталогу
-                conn.execute('''
-                    INSERT INTO expected_sale_prices 
-                    (part_id, price_rub, effective_date, notes)
-                    VALUES (?, ?, ?, ?)
-                ''', (part_id, price, effective_date, notes))
-                
-                added_count += 1
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'added': added_count,
-                'total': len(df)
-            })
-            
-        except Exception as e:
-            return jsonify({'error': f'Ошибка обработки файла: {str(e)}'}), 500
+        return start_upload_job(file, process_expected_prices_upload)
     
     return jsonify({'error': 'Invalid file format'}), 400
 
@@ -2564,12 +3191,14 @@ def api_expected_price_item(price_id):
         
         conn.commit()
         conn.close()
+        cache.delete('expected_prices_count')
         return jsonify({'success': True})
     
     elif request.method == 'DELETE':
         conn.execute('DELETE FROM expected_sale_prices WHERE id = ?', (price_id,))
         conn.commit()
         conn.close()
+        cache.delete('expected_prices_count')
         return jsonify({'success': True})
 
 # ================== СТАТИСТИКА ПРОДАЖ ==================
@@ -2589,6 +3218,12 @@ def api_sales_statistics():
     per_page = request.args.get('per_page', 50, type=int) # 50 записей на страницу по умолчанию
     offset = (page - 1) * per_page
 
+    # Курсорная пагинация - быстрый путь без OFFSET: первая страница с пустым after_id,
+    # следующие - с параметрами из next_cursor. page оставлен для перехода на страницу
+    keyset = 'after_id' in request.args
+    after_period = request.args.get('after_period', '')
+    after_id = request.args.get('after_id', type=int)
+
     # Получаем параметры фильтров
     data_type = request.args.get('data_type', 'all')
     volume_group = request.args.get('volume_group', 'all')
@@ -2599,7 +3234,6 @@ def api_sales_statistics():
     base_query = '''
     FROM sales_statistics ss
     JOIN parts_catalog pc ON ss.part_id = pc.id
-    JOIN brands b ON pc.brand_id = b.id
     WHERE 1=1
     '''
     params = []
@@ -2613,22 +3247,60 @@ def api_sales_statistics():
         params.append(volume_group)
 
     if search:
-        base_query += ' AND (pc.main_article LIKE ? OR b.name LIKE ?)'
+        base_query += ' AND (pc.main_article LIKE ? OR pc.brand_name LIKE ?)'
         search_term = f'%{search}%'
         params.extend([search_term, search_term])
 
+    if keyset:
+        # Поиск по индексу с позиции курсора, без подсчета общего количества
+        keyset_query = '''
+        SELECT
+            ss.*,
+            pc.brand_name,
+            pc.main_article,
+            pc.name_ru
+        ''' + base_query
+        if after_period and after_id is not None:
+            keyset_query += ' AND (ss.period, ss.id) < (?, ?)'
+            params.extend([after_period, after_id])
+        keyset_query += ' ORDER BY ss.period DESC, ss.id DESC LIMIT ?'
+        params.append(per_page + 1)
+
+        stats = conn.execute(keyset_query, params).fetchall()
+        conn.close()
+
+        # Лишняя строка показывает, есть ли следующая страница
+        has_next = len(stats) > per_page
+        stats = stats[:per_page]
+        last = stats[-1] if has_next else None
+        return jsonify({
+            'stats': stats,
+            'has_next': has_next,
+            'next_cursor': {'after_period': last['period'], 'after_id': last['id']} if last else None
+        })
+
     # 3. Выполняем запрос для подсчета ОБЩЕГО количества записей
-    total_count_query = 'SELECT COUNT(ss.id) ' + base_query
-    total_count = conn.execute(total_count_query, params).fetchone()[0]
+    total_count_query = 'SELECT COUNT(*) ' + base_query
+    total_count = cached_count(conn, total_count_query, params)
 
-    # 4. Выполняем основной запрос с LIMIT и OFFSET для получения только одной страницы
+    # 4. Основной запрос: через LIMIT и OFFSET проходят только id записей,
+    # широкие колонки дочитываются для одной страницы
     data_query = '''
     SELECT
         ss.*,
-        b.name as brand_name,
+        pc.brand_name,
         pc.main_article,
         pc.name_ru
-    ''' + base_query + ' ORDER BY ss.period DESC, b.name, pc.main_article LIMIT ? OFFSET ?'
+    FROM (
+        SELECT ss.id
+        ''' + base_query + '''
+        ORDER BY ss.period DESC, pc.brand_name, pc.main_article, ss.id
+        LIMIT ? OFFSET ?
+    ) page_ids
+    JOIN sales_statistics ss ON ss.id = page_ids.id
+    JOIN parts_catalog pc ON ss.part_id = pc.id
+    ORDER BY ss.period DESC, pc.brand_name, pc.main_article, ss.id
+    '''
     params.extend([per_page, offset])
 
     stats = conn.execute(data_query, params).fetchall()
@@ -2636,15 +3308,101 @@ def api_sales_statistics():
 
     # 5. Возвращаем структурированный ответ с данными и мета-информацией о страницах
     return jsonify({
-        'stats': [dict(stat) for stat in stats],
+        'stats': stats,
         'total_count': total_count,
         'current_page': page,
         'total_pages': (total_count + per_page - 1) // per_page
     })
     
+def process_sales_statistics_upload(filepath, data_type):
+    """Разбирает файл статистики и записывает ее в базу; возвращает итог загрузки"""
+    # Читаем только распознанные колонки
+    df = read_excel_columns(filepath, SALES_STATISTICS_COLUMN_RULES)
+
+    # Очистка данных
+    if 'article' in df.columns:
+        df['article'] = normalize_articles(df['article'])
+    if 'brand' in df.columns:
+        df['brand'] = df['brand'].fillna('').astype(str).str.strip()
+
+    df = df.dropna(subset=['article', 'brand', 'period'])
+
+    # Недостающие колонки - значения по умолчанию, строки читаем кортежами
+    for col, default in (('quantity', None), ('volume_group', ''), ('requests', None),
+                         ('source', ''), ('notes', '')):
+        if col not in df.columns:
+            df[col] = default
+    df['volume_group'] = normalize_volume_groups(df['volume_group'])
+
+    conn = get_db_connection()
+
+    try:
+        # Вся загрузка идет одной транзакцией, запись - одним пакетом UPSERT
+        conn.execute('BEGIN IMMEDIATE')
+        rows = {}  # (part_id, period) -> строка для UPSERT
+        processed_count = 0
+
+        # Детали каталога для всего файла находим или создаем пакетно
+        new_brands = set()
+        part_ids = resolve_part_ids(zip(df['brand'], df['article']), conn, new_brands)
+
+        for article, brand_name, period, quantity, volume_group, requests, source, notes in df[
+            ['article', 'brand', 'period', 'quantity', 'volume_group', 'requests', 'source', 'notes']
+        ].itertuples(index=False, name=None):
+            if not article or not brand_name:
+                continue
+
+            # Преобразуем период в дату
+            try:
+                if isinstance(period, str):
+                    period_date = datetime.strptime(period, '%Y-%m-%d').date()
+                else:
+                    period_date = period.date() if hasattr(period, 'date') else datetime.now().date()
+            except:
+                period_date = datetime.now().date()
+
+            part_id = part_ids.get((brand_name, article))
+            if not part_id:
+                continue
+
+            # Повтор строки в файле перезаписывает предыдущую
+            rows[(part_id, period_date.isoformat())] = (
+                part_id, data_type, period_date, quantity, volume_group, requests, source, notes
+            )
+            processed_count += 1
+
+        # Какие записи уже есть в базе - одним запросом, для счетчиков added/updated
+        existing_keys = {
+            (row['part_id'], row['period'])
+            for row in conn.execute(SELECT_SALES_STATISTIC_KEYS_SQL, (
+                data_type, json.dumps(list({part_id for part_id, _ in rows}))
+            ))
+        }
+        added_count = len(rows.keys() - existing_keys)
+        # Повторы строк в файле тоже считаются обновлениями
+        updated_count = processed_count - added_count
+
+        conn.executemany(UPSERT_SALES_STATISTIC_SQL, list(rows.values()))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if new_brands:
+        invalidate_brand_map()
+
+    return {
+        'success': True,
+        'added': added_count,
+        'updated': updated_count,
+        'total': len(df)
+    }
+
 @app.route('/api/sales_statistics/upload', methods=['POST'])
 def api_sales_statistics_upload():
-    """API для загрузки статистики из Excel"""
+    """API для загрузки статистики из Excel: обработка идет в фоне, ответ 202 с адресом статуса"""
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
@@ -2655,105 +3413,7 @@ def api_sales_statistics_upload():
     data_type = request.form.get('data_type', 'own_sales')
     
     if file and file.filename.endswith(('.xlsx', '.xls')):
-        try:
-            df = pd.read_excel(file)
-            
-            # Маппинг колонок
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower: column_mapping[col] = 'article'
-                elif 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'период' in col_lower or 'дата' in col_lower: column_mapping[col] = 'period'
-                elif 'количество' in col_lower: column_mapping[col] = 'quantity'
-                elif 'группа' in col_lower: column_mapping[col] = 'volume_group'
-                elif 'запрос' in col_lower: column_mapping[col] = 'requests'
-                elif 'источник' in col_lower: column_mapping[col] = 'source'
-                elif 'примеч' in col_lower: column_mapping[col] = 'notes'
-            
-            df = df.rename(columns=column_mapping)
-            
-            # Очистка данных
-            if 'article' in df.columns:
-                df['article'] = df['article'].apply(normalize_article)
-            if 'brand' in df.columns:
-                df['brand'] = df['brand'].fillna('').astype(str).str.strip()
-            
-            df = df.dropna(subset=['article', 'brand', 'period'])
-            
-            conn = get_db_connection()
-            added_count = 0
-            updated_count = 0
-            
-            for _, row in df.iterrows():
-                article = row.get('article', '')
-                brand_name = row.get('brand', '')
-                period = row.get('period')
-                quantity = row.get('quantity')
-                volume_group = row.get('volume_group', '')
-                requests = row.get('requests')
-                source = row.get('source', '')
-                notes = row.get('notes', '')
-                
-                if not article or not brand_name:
-                    continue
-                
-                # Преобразуем период в дату
-                try:
-                    if isinstance(period, str):
-                        period_date = datetime.strptime(period, '%Y-%m-%d').date()
-                    else:
-                        period_date = period.date() if hasattr(period, 'date') else datetime.now().date()
-                except:
-                    period_date = datetime.now().date()
-                
-                # НАХОДИМ ИЛИ СОЗДАЕМ ДЕТАЛЬ В КАТАЛОГЕ
-                part_id = get_or_create_part_in_catalog(brand_name, article, conn)
-                
-                if not part_id:
-                    continue
-                
-                # Нормализуем группу объема
-                volume_group_normalized = normalize_volume_group(volume_group)
-                
-                # Проверяем существование записи
-                existing = conn.execute('''
-                    SELECT id FROM sales_statistics 
-                    WHERE part_id = ? AND data_type = ? AND period = ?
-                ''', (part_id, data_type, period_date)).fetchone()
-                
-                if existing:
-                    # Обновляем существующую запись
-                    conn.execute('''
-                        UPDATE sales_statistics 
-                        SET quantity = ?, volume_group = ?, requests_per_month = ?, 
-                            source_name = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (quantity, volume_group_normalized, requests, source, notes, existing['id']))
-                    updated_count += 1
-                else:
-                    # Добавляем новую запись
-                    conn.execute('''
-                        INSERT INTO sales_statistics 
-                        (part_id, data_type, period, quantity, volume_group, 
-                         requests_per_month, source_name, notes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (part_id, data_type, period_date, quantity, volume_group_normalized, 
-                          requests, source, notes))
-                    added_count += 1
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'added': added_count,
-                'updated': updated_count,
-                'total': len(df)
-            })
-            
-        except Exception as e:
-            return jsonify({'error': f'Ошибка обработки файла: {str(e)}'}), 500
+        return start_upload_job(file, process_sales_statistics_upload, data_type)
     
     return jsonify({'error': 'Invalid file format'}), 400
 
@@ -2809,37 +3469,30 @@ def api_sales_statistics_aggregated():
     """API для агрегированной статистики по деталям"""
     conn = get_db_connection()
     
+    # Последняя запись по каждой паре (деталь, тип данных): при MAX() SQLite берет
+    # остальные колонки из той же строки, группировка идет по индексу без сортировки окна
     query = '''
-    WITH LatestStats AS (
-        SELECT 
-            ss.brand_id,
-            ss.main_article,
-            ss.data_type,
-            ss.quantity,
-            ss.volume_group,
-            ss.requests_per_month,
-            ss.period,
-            ROW_NUMBER() OVER (PARTITION BY ss.brand_id, ss.main_article, ss.data_type ORDER BY ss.period DESC) as rn
-        FROM sales_statistics ss
-    )
     SELECT 
-        b.name as brand_name,
-        ls.main_article,
+        pc.brand_name,
+        pc.main_article,
         ls.data_type,
         ls.quantity,
         ls.volume_group,
         ls.requests_per_month,
         ls.period
-    FROM LatestStats ls
-    JOIN brands b ON ls.brand_id = b.id
-    WHERE ls.rn = 1
-    ORDER BY b.name, ls.main_article, ls.data_type
+    FROM (
+        SELECT part_id, data_type, MAX(period) as period, quantity, volume_group, requests_per_month
+        FROM sales_statistics
+        GROUP BY part_id, data_type
+    ) ls
+    JOIN parts_catalog pc ON pc.id = ls.part_id
+    ORDER BY pc.brand_name, pc.main_article, ls.data_type
     '''
     
     stats = conn.execute(query).fetchall()
     conn.close()
     
-    return jsonify([dict(stat) for stat in stats])
+    return jsonify(stats)
 
     
 # ================== КАТАЛОГ ==================
@@ -2864,169 +3517,200 @@ def api_catalog():
     brand_filter = request.args.get('brand', '')
     article_filter = request.args.get('article', '')
     
+    # Курсорная пагинация: after_id (пустой для первой страницы) + after_brand, after_article
+    keyset = 'after_id' in request.args
+    after_brand = request.args.get('after_brand', '')
+    after_article = request.args.get('after_article', '')
+    after_id = request.args.get('after_id', type=int)
+    
     conn = get_db_connection()
     
-    # Базовый запрос
-    query = '''
-    SELECT pc.*, b.name as brand_name 
+    # Базовый запрос (имя бренда хранится в каталоге)
+    base_query = '''
     FROM parts_catalog pc 
-    JOIN brands b ON pc.brand_id = b.id 
     WHERE 1=1
     '''
     params = []
     
     # Добавляем фильтры
     if brand_filter:
-        query += ' AND b.name = ?'
+        base_query += ' AND pc.brand_name = ?'
         params.append(brand_filter)
     
     if article_filter:
-        query += ' AND (pc.main_article LIKE ? OR pc.additional_article LIKE ? OR pc.name_ru LIKE ?)'
-        search_term = f'%{article_filter}%'
-        params.extend([search_term, search_term, search_term])
-    
-    # Добавляем пагинацию
-    query += ' ORDER BY b.name, pc.main_article LIMIT ? OFFSET ?'
-    params.extend([per_page, (page - 1) * per_page])
-    
-    parts = conn.execute(query, params).fetchall()
+        condition, condition_params = catalog_search_condition(article_filter, ('main_article', 'additional_article', 'name_ru'))
+        base_query += ' AND ' + condition
+        params.extend(condition_params)
+    
+    if keyset:
+        # Поиск по индексу (brand_name, main_article) с позиции курсора
+        query = 'SELECT pc.* ' + base_query
+        if after_id is not None:
+            query += ' AND (pc.brand_name, pc.main_article, pc.id) > (?, ?, ?)'
+            params.extend([after_brand, after_article, after_id])
+        query += ' ORDER BY pc.brand_name, pc.main_article, pc.id LIMIT ?'
+        params.append(per_page + 1)
+        
+        parts = conn.execute(query, params).fetchall()
+        conn.close()
+        
+        # Лишняя строка показывает, есть ли следующая страница
+        has_next = len(parts) > per_page
+        parts = parts[:per_page]
+        last = parts[-1] if has_next else None
+        return jsonify({
+            'parts': parts,
+            'has_next': has_next,
+            'next_cursor': {
+                'after_brand': last['brand_name'],
+                'after_article': last['main_article'],
+                'after_id': last['id']
+            } if last else None
+        })
     
-    # Получаем общее количество для пагинации
-    count_query = '''
-    SELECT COUNT(*) 
-    FROM parts_catalog pc 
-    JOIN brands b ON pc.brand_id = b.id 
-    WHERE 1=1
+    # Добавляем пагинацию: через OFFSET проходят только id, строки дочитываются для страницы
+    query = '''
+    SELECT pc.*
+    FROM (
+        SELECT pc.id
+        ''' + base_query + '''
+        ORDER BY pc.brand_name, pc.main_article, pc.id
+        LIMIT ? OFFSET ?
+    ) page_ids
+    JOIN parts_catalog pc ON pc.id = page_ids.id
+    ORDER BY pc.brand_name, pc.main_article, pc.id
     '''
-    count_params = []
-    
-    if brand_filter:
-        count_query += ' AND b.name = ?'
-        count_params.append(brand_filter)
+    parts = conn.execute(query, params + [per_page, (page - 1) * per_page]).fetchall()
     
-    if article_filter:
-        count_query += ' AND (pc.main_article LIKE ? OR pc.additional_article LIKE ? OR pc.name_ru LIKE ?)'
-        search_term = f'%{article_filter}%'
-        count_params.extend([search_term, search_term, search_term])
-    
-    total_count = conn.execute(count_query, count_params).fetchone()[0]
+    # Получаем общее количество для пагинации
+    total_count = cached_count(conn, 'SELECT COUNT(*) ' + base_query, params)
     
     conn.close()
     
-    # Преобразуем в словарь
-    parts_list = [dict(part) for part in parts]
-    
     return jsonify({
-        'parts': parts_list,
+        'parts': parts,
         'total_pages': (total_count + per_page - 1) // per_page,
         'current_page': page,
         'total_count': total_count
     })
 
+def process_catalog_upload(filepath):
+    """Разбирает файл каталога и записывает его в базу; возвращает итог загрузки"""
+    # Читаем только распознанные колонки
+    df = read_excel_columns(filepath, CATALOG_COLUMN_RULES)
+    # Очистка данных
+    if 'main_article' in df.columns:
+        df['main_article'] = normalize_articles(df['main_article'])
+    if 'additional_article' in df.columns:
+        df['additional_article'] = normalize_articles(df['additional_article'])
+    if 'brand' in df.columns:
+        df['brand'] = df['brand'].fillna('').astype(str).str.strip()
+    conn = get_db_connection()
+    new_brands = set()  # Для отслеживания новых брендов
+    detail_fields = ['additional_article', 'name_ru', 'name_en', 'weight', 'volume_coefficient', 'notes']
+
+    # Недостающие колонки не обновляют каталог, а новым деталям дают значения по умолчанию
+    insert_defaults = {'additional_article': '', 'name_ru': '', 'name_en': '', 'notes': ''}
+    absent_fields = {field: insert_defaults.get(field) for field in detail_fields if field not in df.columns}
+    for col in ['main_article', 'brand'] + detail_fields:
+        if col not in df.columns:
+            df[col] = None
+    df = df.dropna(subset=['main_article', 'brand'])
+
+    try:
+        # Вся загрузка идет одной транзакцией, запись - двумя пакетами
+        conn.execute('BEGIN IMMEDIATE')
+        inserts = {}  # (brand_id, main_article) -> поля новой детали
+        updates = {}  # id детали -> заполненные поля
+        added_count = 0
+        updated_count = 0
+
+        # Бренды и уже существующие детали файла - пакетно, до цикла по строкам
+        brand_ids = resolve_brand_ids(df['brand'], conn, new_brands)
+        existing_ids = load_part_ids(
+            {(brand_ids[brand_name], main_article)
+             for brand_name, main_article in zip(df['brand'], df['main_article'])
+             if brand_name in brand_ids},
+            conn
+        )
+
+        for main_article, brand_name, *details in df[
+            ['main_article', 'brand'] + detail_fields
+        ].itertuples(index=False, name=None):
+            brand_id = brand_ids.get(brand_name)
+            if not brand_id:
+                print(f"Ошибка: Не удалось получить или создать бренд для '{brand_name}'")
+                continue
+
+            # Пустые значения не затирают данные каталога
+            filled = {field: value for field, value in zip(detail_fields, details) if not pd.isna(value)}
+
+            # Повтор новой детали в файле обновляет строку, добавленную выше
+            key = (brand_id, main_article)
+            if key in inserts:
+                if filled:
+                    inserts[key].update(filled)
+                    updated_count += 1
+                continue
+
+            existing_id = existing_ids.get(key)
+            if existing_id:
+                if filled:
+                    updates.setdefault(existing_id, {}).update(filled)
+                    updated_count += 1
+            else:
+                inserts[key] = dict(zip(detail_fields, details), **absent_fields)
+                added_count += 1
+
+        # Обновляем существующие записи: незаполненные поля остаются как есть
+        conn.executemany(
+            '''UPDATE parts_catalog SET 
+                additional_article = COALESCE(?, additional_article),
+                name_ru = COALESCE(?, name_ru),
+                name_en = COALESCE(?, name_en),
+                weight = COALESCE(?, weight),
+                volume_coefficient = COALESCE(?, volume_coefficient),
+                notes = COALESCE(?, notes),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?''',
+            [tuple(fields.get(field) for field in detail_fields) + (part_id,)
+             for part_id, fields in updates.items()]
+        )
+
+        # Добавляем новые записи
+        conn.executemany(
+            '''INSERT INTO parts_catalog 
+            (brand_id, main_article, additional_article, name_ru, name_en, weight, volume_coefficient, notes) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(brand_id, main_article) + tuple(fields[field] for field in detail_fields)
+             for (brand_id, main_article), fields in inserts.items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if new_brands:
+        invalidate_brand_map()
+    return {
+        'success': True,
+        'added': added_count,
+        'updated': updated_count,
+        'total': len(df),
+        'new_brands': list(new_brands)  # Возвращаем список новых брендов
+    }
+
 @app.route('/api/catalog/upload', methods=['POST'])
 def api_catalog_upload():
-    """API для загрузки каталога из Excel"""
+    """API для загрузки каталога из Excel: обработка идет в фоне, ответ 202 с адресом статуса"""
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     if file and file.filename.endswith(('.xlsx', '.xls')):
-        try:
-            df = pd.read_excel(file)
-            # Маппинг колонок
-            column_mapping = {}
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower and 'доп' not in col_lower: 
-                    column_mapping[col] = 'main_article'
-                elif 'доп' in col_lower and 'артикул' in col_lower: 
-                    column_mapping[col] = 'additional_article'
-                elif 'марка' in col_lower: column_mapping[col] = 'brand'
-                elif 'название' in col_lower and 'англ' not in col_lower: column_mapping[col] = 'name_ru'
-                elif 'название' in col_lower and 'англ' in col_lower: column_mapping[col] = 'name_en'
-                elif 'вес' in col_lower: column_mapping[col] = 'weight'
-                elif 'коэф' in col_lower and 'объем' in col_lower: column_mapping[col] = 'volume_coefficient'
-                elif 'примеч' in col_lower: column_mapping[col] = 'notes'
-            df = df.rename(columns=column_mapping)
-            # Очистка данных
-            if 'main_article' in df.columns:
-                df['main_article'] = df['main_article'].apply(normalize_article)
-            if 'additional_article' in df.columns:
-                df['additional_article'] = df['additional_article'].apply(normalize_article)
-            if 'brand' in df.columns:
-                df['brand'] = df['brand'].fillna('').astype(str).str.strip()
-            conn = get_db_connection()
-            added_count = 0
-            updated_count = 0
-            new_brands = set()  # Для отслеживания новых брендов
-            for _, row in df.iterrows():
-                if pd.isna(row.get('main_article')) or pd.isna(row.get('brand')):
-                    continue
-
-                # --- ИСПРАВЛЕНО: Проверяем, был ли бренд найден ДО создания ---
-                brand_name = row.get('brand', '')
-                existing_brand_id = find_brand_by_name(brand_name, conn)
-                if not existing_brand_id:
-                    new_brands.add(brand_name)
-
-                # Теперь находим или создаем бренд
-                brand_id = get_or_create_brand(brand_name, conn)
-
-                if not brand_id:
-                    # Если get_or_create_brand не возвращает ID, что-то пошло не так
-                    print(f"Ошибка: Не удалось получить или создать бренд для '{brand_name}'")
-                    continue
-                # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-                # Проверяем существование записи
-                existing = conn.execute(
-                    'SELECT id FROM parts_catalog WHERE brand_id = ? AND main_article = ?',
-                    (brand_id, row.get('main_article', ''))
-                ).fetchone()
-                if existing:
-                    # Обновляем существующую запись
-                    update_data = {}
-                    for field in ['additional_article', 'name_ru', 'name_en', 'weight', 'volume_coefficient', 'notes']:
-                        if field in row and not pd.isna(row[field]):
-                            update_data[field] = row[field]
-                    if update_data:
-                        set_clause = ', '.join([f"{k} = ?" for k in update_data])
-                        values = list(update_data.values()) + [existing['id']]
-                        conn.execute(
-                            f'UPDATE parts_catalog SET {set_clause}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                            values
-                        )
-                        updated_count += 1
-                else:
-                    # Добавляем новую запись
-                    conn.execute(
-                        '''INSERT INTO parts_catalog 
-                        (brand_id, main_article, additional_article, name_ru, name_en, weight, volume_coefficient, notes) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (
-                            brand_id,
-                            row.get('main_article', ''),
-                            row.get('additional_article', ''),
-                            row.get('name_ru', ''),
-                            row.get('name_en', ''),
-                            row.get('weight'),
-                            row.get('volume_coefficient'),
-                            row.get('notes', '')
-                        )
-                    )
-                    added_count += 1
-            conn.commit()
-            conn.close()
-            return jsonify({
-                'success': True,
-                'added': added_count,
-                'updated': updated_count,
-                'total': len(df),
-                'new_brands': list(new_brands)  # Возвращаем список новых брендов
-            })
-        except Exception as e:
-            return jsonify({'error': f'Ошибка обработки файла: {str(e)}'}), 500
+        return start_upload_job(file, process_catalog_upload)
     return jsonify({'error': 'Invalid file format'}), 400
 
 # ... (вставь это внутрь main.py, например, после api_catalog_upload и перед if __name__ == '__main__':) ...
@@ -3049,12 +3733,7 @@ def api_match_brands():
         try:
             df = pd.read_excel(file)
             # Предположим, что колонка с артикулами может называться по-разному, ищем первую подходящую
-            article_col = None
-            for col in df.columns:
-                col_lower = str(col).lower()
-                if 'артикул' in col_lower or 'article' in col_lower:
-                    article_col = col
-                    break
+            article_col = next((col for col in df.columns if ARTICLE_COLUMN_RE.search(str(col).lower())), None)
 
             if not article_col:
                 # Если не найдена колонка с "артикул", используем первую колонку
@@ -3062,50 +3741,50 @@ def api_match_brands():
                 print(f"Предупреждение: Колонка с артикулом не найдена, используется первая колонка: {article_col}")
 
             # Очищаем и нормализуем артикулы
-            df[article_col] = df[article_col].apply(normalize_article)
+            df[article_col] = normalize_articles(df[article_col])
 
             # Убираем строки с пустыми артикулами
             df = df.dropna(subset=[article_col])
             df = df[df[article_col] != '']
 
             conn = get_db_connection()
-            # Создаем словарь {артикул: [список брендов]}
-            article_to_brands = {}
-            for _, row in df.iterrows():
-                article = row[article_col]
-                if article not in article_to_brands:
-                    # Ищем все бренды, связанные с этим артикулом (main_article или additional_article)
-                    brands = conn.execute('''
-                        SELECT DISTINCT b.name
-                        FROM parts_catalog pc
-                        JOIN brands b ON pc.brand_id = b.id
-                        WHERE pc.main_article = ? OR pc.additional_article = ?
-                    ''', (article, article)).fetchall()
-                    brand_list = [brand['name'] for brand in brands]
-                    article_to_brands[article] = brand_list
+            # Создаем словарь {артикул: [список брендов]} одним запросом по обоим артикулам
+            article_to_brands = defaultdict(list)
+            for row in conn.execute('''
+                SELECT article, brand_name
+                FROM (
+                    SELECT j.value as article, pc.brand_name, pc.id
+                    FROM json_each(:articles) j
+                    JOIN parts_catalog pc ON pc.main_article = j.value
+                    UNION ALL
+                    SELECT j.value, pc.brand_name, pc.id
+                    FROM json_each(:articles) j
+                    JOIN parts_catalog pc ON pc.additional_article = j.value
+                )
+                GROUP BY article, brand_name
+                ORDER BY article, MIN(id)
+            ''', {'articles': json.dumps(df[article_col].unique().tolist())}):
+                article_to_brands[row['article']].append(row['brand_name'])
 
             conn.close()
 
-            # Формируем результат с добавленными колонками
-            results = []
-            for _, row in df.iterrows():
-                article = row[article_col]
-                brands_found = article_to_brands.get(article, [])
-                primary_brand = brands_found[0] if brands_found else 'НЕ НАЙДЕН'
-                other_brands = ', '.join(brands_found[1:]) if len(brands_found) > 1 else '' # Соединяем остальные бренды через запятую
-
-                # Копируем все колонки из исходного файла
-                result_row = row.to_dict()
-                result_row['brand_matched'] = primary_brand
-                result_row['other_brands'] = other_brands
-                results.append(result_row)
+            # Формируем результат с добавленными колонками: основной бренд и остальные через запятую
+            df_brands = pd.DataFrame(
+                {
+                    'brand_matched': [brands[0] for brands in article_to_brands.values()],
+                    'other_brands': [', '.join(brands[1:]) for brands in article_to_brands.values()]
+                },
+                index=pd.Index(list(article_to_brands), dtype=object)
+            )
+            df = df.merge(df_brands, left_on=article_col, right_index=True, how='left')
+            df = df.fillna({'brand_matched': 'НЕ НАЙДЕН', 'other_brands': ''})
 
             # Возвращаем результат в виде JSON
             return jsonify({
                 'success': True,
-                'data': results,
+                'data': df.to_dict('records'),
                 'total_articles': len(df),
-                'not_found_count': len([r for r in results if r['brand_matched'] == 'НЕ НАЙДЕН'])
+                'not_found_count': int((df['brand_matched'] == 'НЕ НАЙДЕН').sum())
             })
 
         except Exception as e:
@@ -3127,27 +3806,36 @@ def api_match_brands_export():
         if not results:
             return jsonify({'error': 'Нет данных для экспорта'}), 400
 
-        # Создаем DataFrame из результатов
-        df_to_export = pd.DataFrame(results)
+        # Колонки в порядке первого появления, как у DataFrame из списка словарей
+        columns = list(dict.fromkeys(key for result_row in results for key in result_row))
+
+        # Пишем Excel потоково, строка за строкой
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Результаты')
+
+        header_cells = []
+        for column in columns:
+            cell = WriteOnlyCell(worksheet, value=column)
+            cell.font = Font(bold=True)
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+
+        for result_row in results:
+            worksheet.append([result_row.get(column) for column in columns])
+
+        # Пишем книгу во временный файл: сервер отдаст его без копии в памяти
+        export_file = save_workbook_to_temp_file(workbook)
 
         # Генерируем имя файла
         filename = f"matched_brands_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
 
-        # Сохраняем DataFrame в байтовый поток
-        from io import BytesIO
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_to_export.to_excel(writer, sheet_name='Результаты', index=False)
-        processed_data = output.getvalue()
-
         # Возвращаем файл как прикрепленный файл
-        from flask import send_file
-        output.seek(0) # Смещаем указатель в начало потока
         return send_file(
-            output,
+            export_file,
             as_attachment=True,
             download_name=filename, # Используем download_name вместо attachment_filename
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            conditional=True
         )
 
     except Exception as e:
@@ -3169,16 +3857,19 @@ def api_catalog_item(part_id):
         conn.close()
         
         if part:
-            return jsonify(dict(part))
+            return jsonify(part)
         else:
             return jsonify({'error': 'Part not found'}), 404
     
     elif request.method == 'PUT':
-        data = request.get_json()
+        data = parse_json_body(PART_UPDATE_FIELDS)
+        if data is None:
+            conn.close()
+            return jsonify({'error': 'Некорректные данные'}), 400
         
         # Находим ID бренда по имени
         brand = conn.execute(
-            'SELECT id FROM brands WHERE name = ?', (data.get('brand', ''),)
+            'SELECT id FROM brands WHERE name = ?', (data['brand'],)
         ).fetchone()
         
         if not brand:
@@ -3194,13 +3885,13 @@ def api_catalog_item(part_id):
             WHERE id = ?''',
             (
                 brand['id'],
-                data.get('main_article', ''),
-                data.get('additional_article', ''),
-                data.get('name_ru', ''),
-                data.get('name_en', ''),
-                data.get('weight'),
-                data.get('volume_coefficient'),
-                data.get('notes', ''),
+                data['main_article'],
+                data['additional_article'],
+                data['name_ru'],
+                data['name_en'],
+                data['weight'],
+                data['volume_coefficient'],
+                data['notes'],
                 part_id
             )
         )
@@ -3223,37 +3914,27 @@ def api_catalog_item(part_id):
         
         return jsonify({'success': True})
 
-def check_currency_rates(conn):
-    """Проверяет наличие необходимых курсов валют"""
-    suppliers_currencies = conn.execute('''
-        SELECT DISTINCT currency FROM suppliers WHERE currency != 'RUB'
+@cache.memoize(timeout=CURRENCY_RATES_TTL)
+def check_currency_rates():
+    """
+    Проверяет наличие необходимых курсов валют: валюты поставщиков без курса - одним запросом
+    (кэшируется, сбрасывается при изменении курсов и поставщиков)
+    """
+    conn = get_db_connection()
+    missing_rates = conn.execute('''
+        SELECT DISTINCT s.currency 
+        FROM suppliers s
+        WHERE s.currency != 'RUB'
+          AND NOT EXISTS (SELECT 1 FROM currency_rates cr WHERE cr.currency_code = s.currency)
     ''').fetchall()
+    conn.close()
     
-    missing_rates = []
-    for supplier in suppliers_currencies:
-        rate = conn.execute('''
-            SELECT currency_code FROM currency_rates 
-            WHERE currency_code = ? 
-            ORDER BY created_at DESC LIMIT 1
-        ''', (supplier['currency'],)).fetchone()
-        
-        if not rate:
-            missing_rates.append(supplier['currency'])
-    
-    return missing_rates
+    return [row['currency'] for row in missing_rates]
 
 # ================== АНАЛИЗ ЦЕН ==================
-@app.route('/analysis')
-@cache.cached(timeout=300)  # 5 минут
-def analysis():
-    conn = get_db_connection()
-
-    # Проверяем курсы валют
-    missing_rates = check_currency_rates(conn)
-    if missing_rates:
-        flash(f'⚠️ Отсутствуют курсы для валют: {", ".join(missing_rates)}. Некоторые цены могут отображаться некорректно.', 'warning')
-    
-    query = '''
+# Лучшая цена по каждой детали и число предложений (сам список отдает /api/part_suppliers/<id>);
+# курсы передаются JSON-параметром :rates
+ANALYSIS_SQL = '''
     WITH LatestSupplierPrices AS (
         SELECT 
             pc.id as part_id,
@@ -3262,16 +3943,10 @@ def analysis():
             pc.name_ru,
             p.price as original_price,
             s.currency as original_currency,
-            -- Конвертируем в рубли (исправленная версия)
+            -- Конвертируем в рубли по кэшированным курсам
             CASE 
                 WHEN s.currency = 'RUB' THEN p.price
-                ELSE p.price * (
-                    SELECT rate_to_rub 
-                    FROM currency_rates 
-                    WHERE currency_code = s.currency 
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                )
+                ELSE p.price * lr.value
             END as price_rub,
             pl.upload_date,
             s.name as supplier_name,
@@ -3282,6 +3957,7 @@ def analysis():
         JOIN prices p ON p.part_id = pc.id
         JOIN price_lists pl ON p.price_list_id = pl.id
         JOIN suppliers s ON pl.supplier_id = s.id
+        LEFT JOIN json_each(:rates) lr ON lr.key = s.currency
         JOIN regions r ON s.region_id = r.id
         WHERE pl.is_active = 1
     ),
@@ -3300,7 +3976,9 @@ def analysis():
             ROW_NUMBER() OVER (
                 PARTITION BY part_id 
                 ORDER BY price_rub ASC, upload_date DESC, supplier_name
-            ) as rn_best
+            ) as rn_best,
+            -- Только число предложений: сам список загружается по запросу (/api/part_suppliers)
+            COUNT(*) OVER (PARTITION BY part_id) as offers_count
         FROM LatestSupplierPrices
         WHERE rn_supplier = 1
     )
@@ -3315,36 +3993,81 @@ def analysis():
         best_supplier,
         best_date,
         best_region,
-        (SELECT GROUP_CONCAT(
-            supplier_name || ' (' || 
-            original_price || ' ' || original_currency || 
-            CASE 
-                WHEN original_currency != 'RUB' THEN ' ≈ ' || ROUND(price_rub, 2) || ' руб.'
-                ELSE ' руб.'
-            END || ')'
-        ) 
-         FROM LatestSupplierPrices lsp 
-         WHERE lsp.part_id = bp.part_id AND lsp.rn_supplier = 1) as all_suppliers
-    FROM BestPrices bp
+        offers_count
+    FROM BestPrices
     WHERE rn_best = 1
     ORDER BY brand, main_article
     '''
+
+@app.route('/analysis')
+def analysis():
+    cached_page = cache.get('analysis_page')
+    if cached_page is not None:
+        return cached_page
+    
+    conn = get_db_connection()
+
+    # Проверяем курсы валют: предупреждение выводит сам шаблон, flash для потоковой страницы не подходит
+    missing_rates = check_currency_rates()
     
+    # Cookie сессии уходит до начала потока, поэтому накопленные сообщения забираем сейчас,
+    # иначе они останутся в сессии и покажутся еще раз. base.html получит их из кэша запроса
+    flashed_messages = get_flashed_messages()
     
-    parts = conn.execute(query).fetchall()
+    # Получаем уникальные значения для фильтров одним запросом
+    filter_values = {'brands': [], 'suppliers': [], 'regions': []}
+    for row in conn.execute(SELECT_ANALYSIS_FILTERS_SQL):
+        filter_values[row['kind']].append(row['name'])
+    for names in filter_values.values():
+        names.sort()
     
-    # Получаем уникальные значения для фильтров
-    brands = conn.execute('SELECT DISTINCT name FROM brands WHERE name IS NOT NULL ORDER BY name').fetchall()
-    suppliers = conn.execute('SELECT DISTINCT name FROM suppliers ORDER BY name').fetchall()
-    regions = conn.execute('SELECT DISTINCT name FROM regions ORDER BY name').fetchall()
+    parts = conn.execute(ANALYSIS_SQL, {'rates': json.dumps(get_currency_rates())})
     
+    @stream_with_context
+    def generate():
+        # Строки курсора рендерятся по мере чтения, без промежуточного списка
+        chunks = []
+        try:
+            for chunk in stream_template('analysis.html', parts=parts, missing_rates=missing_rates,
+                                         **filter_values):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            conn.close()
+        # Кэшируем только полностью отданную страницу без чужих сообщений
+        if not flashed_messages:
+            cache.set('analysis_page', ''.join(chunks), timeout=300)  # 5 минут
+    
+    return Response(generate())
+
+# Предложения по одной детали для окна "Все предложения" на странице анализа
+PART_SUPPLIERS_SQL = '''
+    SELECT 
+        s.name as supplier_name,
+        p.price as original_price,
+        s.currency as original_currency,
+        CASE 
+            WHEN s.currency = 'RUB' THEN p.price
+            ELSE p.price * lr.value
+        END as price_rub,
+        MAX(pl.upload_date) as upload_date
+    FROM prices p
+    JOIN price_lists pl ON p.price_list_id = pl.id
+    JOIN suppliers s ON pl.supplier_id = s.id
+    LEFT JOIN json_each(:rates) lr ON lr.key = s.currency
+    WHERE p.part_id = :part_id AND pl.is_active = 1
+    GROUP BY s.id
+    ORDER BY price_rub
+    '''
+
+@app.route('/api/part_suppliers/<int:part_id>')
+def api_part_suppliers(part_id):
+    """Все предложения по детали: последняя цена каждого поставщика из активных прайс-листов"""
+    conn = get_db_connection()
+    offers = conn.execute(PART_SUPPLIERS_SQL, {'part_id': part_id, 'rates': json.dumps(get_currency_rates())}).fetchall()
     conn.close()
     
-    return render_template('analysis.html', 
-                         parts=parts,
-                         brands=[b['name'] for b in brands],
-                         suppliers=[s['name'] for s in suppliers],
-                         regions=[r['name'] for r in regions])
+    return jsonify(offers)
 
 # ================== СРАВНЕНИЕ ПОСТАВЩИКОВ ==================
 @app.route('/supplier_comparison')
@@ -3362,19 +4085,10 @@ def supplier_comparison():
     conn.close()
     
     return render_template('supplier_comparison.html', suppliers=suppliers)
-@app.route('/api/supplier_comparison')
-def api_supplier_comparison():
-    supplier1_id = request.args.get('supplier1')
-    supplier2_id = request.args.get('supplier2')
-    show_all = request.args.get('show_all', 'false').lower() == 'true'
-    
-    if not supplier1_id:
-        return jsonify({'error': 'Не выбран поставщик 1'}), 400
-    
-    conn = get_db_connection()
-    
-    # Упрощенный и исправленный запрос
-    query = '''
+
+# Последняя цена поставщика по каждой детали - группировкой с MAX(upload_date):
+# остальные колонки SQLite берет из той же строки, оконная сортировка не нужна
+SUPPLIER1_PRICES_CTE = '''
     WITH Supplier1Prices AS (
         SELECT 
             pc.id as part_id,
@@ -3383,52 +4097,60 @@ def api_supplier_comparison():
             pc.name_ru,
             p.price as price1_original,
             s.currency as currency1,
-            -- Конвертируем в рубли
+            -- Конвертируем в рубли по кэшированным курсам
             CASE 
                 WHEN s.currency = 'RUB' THEN p.price
-                ELSE p.price * (
-                    SELECT rate_to_rub 
-                    FROM currency_rates 
-                    WHERE currency_code = s.currency 
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                )
+                ELSE p.price * lr.value
             END as price1_rub,
-            pl.upload_date as date1,
-            s.name as supplier1_name,
-            ROW_NUMBER() OVER (PARTITION BY pc.id ORDER BY pl.upload_date DESC) as rn1
+            MAX(pl.upload_date) as date1,
+            s.name as supplier1_name
         FROM parts_catalog pc
         JOIN brands b ON pc.brand_id = b.id
         JOIN prices p ON p.part_id = pc.id
         JOIN price_lists pl ON p.price_list_id = pl.id
         JOIN suppliers s ON pl.supplier_id = s.id
-        WHERE pl.is_active = 1 AND s.id = ?
-    ),
+        LEFT JOIN json_each(:rates) lr ON lr.key = s.currency
+        WHERE pl.is_active = 1 AND s.id = :supplier1_id
+        GROUP BY pc.id
+    )
+    '''
+
+# Сравнение без второго поставщика: его колонки пустые
+SUPPLIER_COMPARISON_SINGLE_SQL = SUPPLIER1_PRICES_CTE + '''
+    SELECT 
+        s1.*,
+        NULL as price2_original,
+        NULL as currency2,
+        NULL as price2_rub,
+        NULL as date2,
+        NULL as supplier2_name,
+        0 as has_intersection
+    FROM Supplier1Prices s1
+    ORDER BY s1.brand, s1.main_article
+    '''
+
+# Сравнение двух поставщиков: все детали первого или только общие
+SUPPLIER_COMPARISON_PAIR_SQL = SUPPLIER1_PRICES_CTE + ''',
     Supplier2Prices AS (
         SELECT 
             pc.id as part_id,
             p.price as price2_original,
             s.currency as currency2,
-            -- Конвертируем в рубли
+            -- Конвертируем в рубли по кэшированным курсам
             CASE 
                 WHEN s.currency = 'RUB' THEN p.price
-                ELSE p.price * (
-                    SELECT rate_to_rub 
-                    FROM currency_rates 
-                    WHERE currency_code = s.currency 
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                )
+                ELSE p.price * lr.value
             END as price2_rub,
-            pl.upload_date as date2,
-            s.name as supplier2_name,
-            ROW_NUMBER() OVER (PARTITION BY pc.id ORDER BY pl.upload_date DESC) as rn2
+            MAX(pl.upload_date) as date2,
+            s.name as supplier2_name
         FROM parts_catalog pc
         JOIN brands b ON pc.brand_id = b.id
         JOIN prices p ON p.part_id = pc.id
         JOIN price_lists pl ON p.price_list_id = pl.id
         JOIN suppliers s ON pl.supplier_id = s.id
-        WHERE pl.is_active = 1 AND s.id = ?
+        LEFT JOIN json_each(:rates) lr ON lr.key = s.currency
+        WHERE pl.is_active = 1 AND s.id = :supplier2_id
+        GROUP BY pc.id
     )
     SELECT 
         s1.part_id,
@@ -3445,54 +4167,82 @@ def api_supplier_comparison():
         s2.price2_rub,
         s2.date2,
         s2.supplier2_name,
-        CASE 
-            WHEN s2.price2_rub IS NOT NULL AND s1.price1_rub IS NOT NULL AND s1.price1_rub > 0 
-            THEN ROUND(((s2.price2_rub - s1.price1_rub) / s1.price1_rub) * 100, 2)
-            ELSE NULL 
-        END as price_diff_percent,
         CASE 
             WHEN s2.part_id IS NOT NULL THEN 1 
             ELSE 0 
         END as has_intersection
     FROM Supplier1Prices s1
-    LEFT JOIN Supplier2Prices s2 ON s1.part_id = s2.part_id AND s2.rn2 = 1
-    WHERE s1.rn1 = 1
+    LEFT JOIN Supplier2Prices s2 ON s1.part_id = s2.part_id
     '''
+SUPPLIER_COMPARISON_ALL_SQL = SUPPLIER_COMPARISON_PAIR_SQL + ' ORDER BY s1.brand, s1.main_article'
+SUPPLIER_COMPARISON_COMMON_SQL = SUPPLIER_COMPARISON_PAIR_SQL + ' WHERE s2.part_id IS NOT NULL ORDER BY s1.brand, s1.main_article'
+
+@cache.memoize(timeout=SUPPLIER_COMPARISON_TTL)
+def load_supplier_comparison(supplier1_id, supplier2_id, show_all):
+    """
+    Сравнение цен двух поставщиков (кэшируется по параметрам, сбрасывается
+    при изменении прайс-листов и курсов). Строки - словари, чтобы их можно было кэшировать.
+    """
+    conn = get_db_connection()
     
-    if not show_all and supplier2_id:
-        query += " AND s2.part_id IS NOT NULL"
-    
-    query += " ORDER BY s1.brand, s1.main_article"
-    
-    params = [supplier1_id]
-    if supplier2_id:
-        params.append(supplier2_id)
+    if supplier2_id is None:
+        query = SUPPLIER_COMPARISON_SINGLE_SQL
+    elif show_all:
+        query = SUPPLIER_COMPARISON_ALL_SQL
     else:
-        params.append(supplier1_id)
+        query = SUPPLIER_COMPARISON_COMMON_SQL
+    
+    params = {
+        'supplier1_id': supplier1_id,
+        'supplier2_id': supplier2_id,
+        'rates': json.dumps(get_currency_rates())
+    }
     
     try:
-        results = conn.execute(query, params).fetchall()
-        
-        # Преобразуем в словарь для JSON
-        comparison_data = []
-        for row in results:
-            comparison_data.append(dict(row))
-        
+        comparison_data = conn.execute(query, params).fetchall()
+    finally:
         conn.close()
-        return jsonify(comparison_data)
-        
+    
+    # Разница цен в процентах - одной векторной операцией по всем строкам;
+    # без цены второго поставщика или с нулевой ценой первого - None
+    price1 = pd.Series([row['price1_rub'] for row in comparison_data], dtype=float)
+    price2 = pd.Series([row['price2_rub'] for row in comparison_data], dtype=float)
+    diff_percent = ((price2 - price1) / price1.where(price1 > 0) * 100).round(2)
+    diff_percent = diff_percent.astype(object).where(diff_percent.notna(), None)
+    
+    return [
+        dict(zip(row.keys(), row), price_diff_percent=diff)
+        for row, diff in zip(comparison_data, diff_percent)
+    ]
+
+@app.route('/api/supplier_comparison')
+def api_supplier_comparison():
+    # Целые ID: привязываются к индексированному suppliers.id без преобразования типов
+    supplier1_id = request.args.get('supplier1', type=int)
+    supplier2_id = request.args.get('supplier2', type=int)
+    show_all = request.args.get('show_all', 'false').lower() == 'true'
+    
+    if not supplier1_id:
+        return jsonify({'error': 'Не выбран поставщик 1'}), 400
+    
+    try:
+        return jsonify(load_supplier_comparison(supplier1_id, supplier2_id, show_all))
     except Exception as e:
-        conn.close()
         return jsonify({'error': f'Ошибка базы данных: {str(e)}'}), 500
 
 
-@app.route('/currency_rates')
-def manage_currency_rates():
-    """Управление курсами валют"""
+@cache.memoize(timeout=CURRENCY_RATES_TTL)
+def get_currency_rate_list():
+    """Все записи курсов валют для страницы и API (кэшируются, сбрасываются при изменении курсов)"""
     conn = get_db_connection()
     rates = conn.execute('SELECT * FROM currency_rates ORDER BY currency_code').fetchall()
     conn.close()
-    return render_template('currency_rates.html', rates=rates)
+    return [dict(zip(rate.keys(), rate)) for rate in rates]
+
+@app.route('/currency_rates')
+def manage_currency_rates():
+    """Управление курсами валют"""
+    return render_template('currency_rates.html', rates=get_currency_rate_list())
 
 @app.route('/delivery_costs')
 def manage_delivery_costs():
@@ -3519,15 +4269,17 @@ def api_currency_rates():
     conn = get_db_connection()
     
     if request.method == 'GET':
-        rates = conn.execute('SELECT * FROM currency_rates ORDER BY currency_code').fetchall()
         conn.close()
-        return jsonify([dict(rate) for rate in rates])
+        return jsonify(get_currency_rate_list())
     
     elif request.method == 'POST':
-        data = request.get_json()
-        currency_code = data.get('currency_code', '').upper()
-        rate_to_rub = data.get('rate_to_rub')
-        description = data.get('description', '')
+        data = parse_json_body(CURRENCY_RATE_FIELDS)
+        if data is None:
+            conn.close()
+            return jsonify({'error': 'Некорректные данные'}), 400
+        currency_code = data['currency_code'].upper()
+        rate_to_rub = data['rate_to_rub']
+        description = data['description']
         
         if not currency_code or not rate_to_rub:
             conn.close()
@@ -3541,16 +4293,20 @@ def api_currency_rates():
             
             conn.commit()
             conn.close()
+            invalidate_currency_rate_caches()
             return jsonify({'success': True})
         except sqlite3.IntegrityError:
             conn.close()
             return jsonify({'error': 'Курс для этой валюты уже существует'}), 400
     
     elif request.method == 'PUT':
-        data = request.get_json()
-        currency_code = data.get('currency_code', '').upper()
-        rate_to_rub = data.get('rate_to_rub')
-        description = data.get('description', '')
+        data = parse_json_body(CURRENCY_RATE_FIELDS)
+        if data is None:
+            conn.close()
+            return jsonify({'error': 'Некорректные данные'}), 400
+        currency_code = data['currency_code'].upper()
+        rate_to_rub = data['rate_to_rub']
+        description = data['description']
         
         if not currency_code or not rate_to_rub:
             conn.close()
@@ -3564,6 +4320,7 @@ def api_currency_rates():
         
         conn.commit()
         conn.close()
+        invalidate_currency_rate_caches()
         return jsonify({'success': True})
 
 @app.route('/api/delivery_costs', methods=['GET', 'POST', 'PUT'])
@@ -3579,14 +4336,17 @@ def api_delivery_costs():
             ORDER BY r.name
         ''').fetchall()
         conn.close()
-        return jsonify([dict(cost) for cost in costs])
+        return jsonify(costs)
     
     elif request.method == 'POST':
-        data = request.get_json()
-        region_id = data.get('region_id')
-        cost_per_kg = data.get('cost_per_kg')
-        min_cost = data.get('min_cost')
-        description = data.get('description', '')
+        data = parse_json_body(DELIVERY_COST_FIELDS)
+        if data is None:
+            conn.close()
+            return jsonify({'error': 'Некорректные данные'}), 400
+        region_id = data['region_id']
+        cost_per_kg = data['cost_per_kg']
+        min_cost = data['min_cost']
+        description = data['description']
         
         if not region_id or not cost_per_kg or not min_cost:
             conn.close()
@@ -3616,11 +4376,14 @@ def api_delivery_costs():
             return jsonify({'error': f'Ошибка: {str(e)}'}), 500
     
     elif request.method == 'PUT':
-        data = request.get_json()
-        cost_id = data.get('id')
-        cost_per_kg = data.get('cost_per_kg')
-        min_cost = data.get('min_cost')
-        description = data.get('description', '')
+        data = parse_json_body(DELIVERY_COST_FIELDS)
+        if data is None:
+            conn.close()
+            return jsonify({'error': 'Некорректные данные'}), 400
+        cost_id = data['id']
+        cost_per_kg = data['cost_per_kg']
+        min_cost = data['min_cost']
+        description = data['description']
         
         if not cost_id or not cost_per_kg or not min_cost:
             conn.close()
@@ -3639,6 +4402,7 @@ def api_delivery_costs():
 
 # ================== API ДЛЯ ВЫПАДАЮЩИХ СПИСКОВ ==================
 @app.route('/api/suppliers')
+@cache.cached(timeout=300, key_prefix='suppliers_list')
 def api_suppliers():
     conn = get_db_connection()
     suppliers = conn.execute('''
@@ -3657,6 +4421,7 @@ def api_suppliers():
 if __name__ == '__main__':
     if not os.path.exists(app.config['DATABASE']):
         init_db()
+    upgrade_db()
     
     print(f"🚀 Запуск в режиме: {'production' if app.config.get('REQUIRE_AUTH') else 'development'}")
     print(f"🔐 Авторизация: {'ВКЛ' if app.config.get('REQUIRE_AUTH') else 'ВЫКЛ'}")
@@ -0,0 +1,76 @@
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+
+from app import (
+    app,
+    init_db,
+    upgrade_db,
+    ANALYSIS_SQL,
+    PART_SUPPLIERS_SQL,
+    SUPPLIER_COMPARISON_SINGLE_SQL,
+    SUPPLIER_COMPARISON_ALL_SQL,
+    SUPPLIER_COMPARISON_COMMON_SQL,
+)
+
+# Запросы и индексы, которые должны быть в их планах на базе, созданной по schema.sql
+QUERY_PLAN_EXPECTATIONS = {
+    'Анализ цен': (ANALYSIS_SQL, ('idx_price_lists_active', 'idx_prices_price_list')),
+    'Предложения по детали': (PART_SUPPLIERS_SQL, ('idx_prices_part_pricelist',)),
+    'Сравнение: один поставщик': (
+        SUPPLIER_COMPARISON_SINGLE_SQL, ('idx_price_lists_supplier_active_date', 'idx_prices_price_list')
+    ),
+    'Сравнение: все детали': (
+        SUPPLIER_COMPARISON_ALL_SQL, ('idx_price_lists_supplier_active_date', 'idx_prices_price_list')
+    ),
+    'Сравнение: общие детали': (
+        SUPPLIER_COMPARISON_COMMON_SQL, ('idx_price_lists_supplier_active_date', 'idx_prices_price_list')
+    ),
+}
+
+# Полный просмотр таблицы цен (в запросах она всегда под псевдонимом p)
+PRICES_SCAN_RE = re.compile(r'^SCAN (p|prices)\b')
+
+# Значения параметров на план не влияют, нужны только для подстановки
+QUERY_PARAMS = {'rates': '{}', 'supplier1_id': 1, 'supplier2_id': 2, 'part_id': 1}
+
+def check_query_plans():
+    """
+    Проверяет планы ключевых запросов на временной базе, созданной init_db/upgrade_db:
+    ожидаемые индексы используются, таблица цен не просматривается целиком
+    """
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app.config['DATABASE'] = os.path.join(tmp_dir, 'query_plans.db')
+        init_db()
+        upgrade_db()
+
+        conn = sqlite3.connect(app.config['DATABASE'])
+        conn.row_factory = sqlite3.Row
+        try:
+            for name, (query, expected_indexes) in QUERY_PLAN_EXPECTATIONS.items():
+                plan = [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, QUERY_PARAMS)]
+
+                for index_name in expected_indexes:
+                    if not any(index_name in detail for detail in plan):
+                        problems.append(f"{name}: не используется индекс {index_name}")
+
+                for detail in plan:
+                    if PRICES_SCAN_RE.match(detail):
+                        problems.append(f"{name}: полный просмотр таблицы цен ({detail})")
+        finally:
+            conn.close()
+
+    if problems:
+        print("Найдены проблемы в планах запросов:")
+        for problem in problems:
+            print(f"  - {problem}")
+        return False
+
+    print(f"Планы {len(QUERY_PLAN_EXPECTATIONS)} запросов в порядке")
+    return True
+
+if __name__ == '__main__':
+    sys.exit(0 if check_query_plans() else 1)
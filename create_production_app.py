@@ -1,8 +1,9 @@
-from app import app
+from app import app, upgrade_db
 from config import ProductionConfig
 
 if __name__ == '__main__':
     app.config.from_object(ProductionConfig)
+    upgrade_db()
     
     # Для продакшена используем Waitress вместо dev-сервера
     from waitress import serve
@@ -29,25 +29,13 @@ def migrate_brands():
         
         print(f"Найдено {len(unique_brands)} уникальных брендов")
         
-        # 3. Добавляем бренды в новую таблицу
-        brand_map = {}
-        for row in unique_brands:
-            brand_name = row['brand']
-            try:
-                cursor = conn.execute(
-                    'INSERT INTO brands (name) VALUES (?)',
-                    (brand_name,)
-                )
-                brand_map[brand_name] = cursor.lastrowid
-                print(f"Добавлен бренд: {brand_name} (ID: {cursor.lastrowid})")
-            except sqlite3.IntegrityError:
-                # Если бренд уже существует
-                existing = conn.execute(
-                    'SELECT id FROM brands WHERE name = ?', 
-                    (brand_name,)
-                ).fetchone()
-                brand_map[brand_name] = existing['id']
-                print(f"Бренд уже существует: {brand_name} (ID: {existing['id']})")
+        # 3. Добавляем бренды в новую таблицу одним пакетом (существующие пропускаются)
+        conn.executemany(
+            'INSERT OR IGNORE INTO brands (name) VALUES (?)',
+            [(row['brand'],) for row in unique_brands]
+        )
+        brands_count = conn.execute('SELECT COUNT(*) FROM brands').fetchone()[0]
+        print(f"Брендов в справочнике: {brands_count}")
         
         # 4. Создаем временную таблицу с новой структурой
         conn.execute('''
@@ -67,30 +55,18 @@ def migrate_brands():
             )
         ''')
         
-        # 5. Копируем данные в новую таблицу
-        parts = conn.execute('SELECT * FROM parts_catalog').fetchall()
-        
-        for part in parts:
-            brand_id = brand_map.get(part['brand'])
-            if brand_id:
-                conn.execute('''
-                    INSERT INTO parts_catalog_new 
-                    (brand_id, main_article, additional_article, name_ru, name_en, weight, volume_coefficient, notes, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    brand_id,
-                    part['main_article'],
-                    part['additional_article'],
-                    part['name_ru'],
-                    part['name_en'],
-                    part['weight'],
-                    part['volume_coefficient'],
-                    part['notes'],
-                    part['created_at'],
-                    part['updated_at']
-                ))
+        # 5. Копируем данные в новую таблицу одним запросом, бренд - через справочник
+        cursor = conn.execute('''
+            INSERT INTO parts_catalog_new 
+            (brand_id, main_article, additional_article, name_ru, name_en, weight, volume_coefficient, notes, created_at, updated_at)
+            SELECT 
+                b.id, pc.main_article, pc.additional_article, pc.name_ru, pc.name_en, 
+                pc.weight, pc.volume_coefficient, pc.notes, pc.created_at, pc.updated_at
+            FROM parts_catalog pc
+            JOIN brands b ON b.name = pc.brand
+        ''')
         
-        print(f"Перенесено {len(parts)} записей в новую таблицу")
+        print(f"Перенесено {cursor.rowcount} записей в новую таблицу")
         
         # 6. Заменяем старую таблицу на новую
         conn.execute('DROP TABLE parts_catalog')
@@ -101,6 +77,9 @@ def migrate_brands():
         conn.execute('CREATE INDEX IF NOT EXISTS idx_parts_main_article ON parts_catalog(main_article)')
         conn.execute('CREATE INDEX IF NOT EXISTS idx_parts_additional_article ON parts_catalog(additional_article)')
         
+        # 8. Обновляем статистику планировщика под новую таблицу и индексы
+        conn.execute('ANALYZE')
+        
         conn.commit()
         print("Миграция успешно завершена!")
         
@@ -29,6 +29,7 @@ CREATE TABLE IF NOT EXISTS suppliers (
 CREATE TABLE IF NOT EXISTS parts_catalog (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     brand_id INTEGER NOT NULL,
+    brand_name TEXT,  -- Денормализованное имя бренда (поддерживается триггерами)
     main_article TEXT NOT NULL,
     additional_article TEXT,
     name_ru TEXT,
@@ -97,6 +98,16 @@ CREATE TABLE IF NOT EXISTS expected_sale_prices (
     FOREIGN KEY (part_id) REFERENCES parts_catalog (id)
 );
 
+-- Актуальная цена продажи по каждой детали (поддерживается триггерами)
+CREATE TABLE IF NOT EXISTS latest_expected_price (
+    part_id INTEGER PRIMARY KEY,
+    price_id INTEGER NOT NULL,
+    price_rub REAL NOT NULL,
+    effective_date DATE NOT NULL,
+    FOREIGN KEY (part_id) REFERENCES parts_catalog (id),
+    FOREIGN KEY (price_id) REFERENCES expected_sale_prices (id)
+);
+
 -- СТАТИСТИКА ПРОДАЖ (ПЕРЕДЕЛАНА!)
 CREATE TABLE IF NOT EXISTS sales_statistics (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -114,9 +125,16 @@ CREATE TABLE IF NOT EXISTS sales_statistics (
 );
 
 CREATE INDEX IF NOT EXISTS idx_expected_prices_part ON expected_sale_prices(part_id);
+CREATE INDEX IF NOT EXISTS idx_expected_prices_part_date ON expected_sale_prices(part_id, effective_date DESC, price_rub);
+CREATE INDEX IF NOT EXISTS idx_expected_prices_part_date_created ON expected_sale_prices(part_id, effective_date DESC, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_sales_stats_part ON sales_statistics(part_id);
 CREATE INDEX IF NOT EXISTS idx_sales_stats_type ON sales_statistics(data_type);
+CREATE INDEX IF NOT EXISTS idx_sales_stats_type_vg_period ON sales_statistics(data_type, volume_group, period DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_sales_stats_period ON sales_statistics(period);
+CREATE INDEX IF NOT EXISTS idx_sales_stats_part_period ON sales_statistics(part_id, period DESC, data_type, quantity);
+-- Одна запись на деталь, тип данных и период: ключ UPSERT при загрузке статистики
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_stats_unique ON sales_statistics(part_id, data_type, period);
+DROP INDEX IF EXISTS idx_sales_stats_part_type_period;
 
 -- Таблица для сохранения заказов
 CREATE TABLE IF NOT EXISTS purchase_orders (
@@ -152,7 +170,114 @@ CREATE INDEX IF NOT EXISTS idx_suppliers_region ON suppliers(region_id);
 CREATE INDEX IF NOT EXISTS idx_brands_name ON brands(name);
 
 -- Добавить в schema.sql
-CREATE INDEX IF NOT EXISTS idx_prices_composite ON prices(part_id, price_list_id);
 CREATE INDEX IF NOT EXISTS idx_price_lists_supplier_date ON price_lists(supplier_id, upload_date DESC);
 CREATE INDEX IF NOT EXISTS idx_parts_brand_article ON parts_catalog(brand_id, main_article);
 
+-- Покрывающие индексы для горячих запросов
+CREATE INDEX IF NOT EXISTS idx_prices_price_list ON prices(price_list_id, part_id, price);
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id, part_id);
+CREATE INDEX IF NOT EXISTS idx_parts_brand_name_article ON parts_catalog(brand_name, main_article);
+
+-- Покрывающие индексы для цен по детали и прайс-листов поставщика. По детали (part_id) идут
+-- окно "Все предложения" и анализ, когда план начинается с каталога; по поставщику - сравнение,
+-- когда план начинается с поставщика. Какой путь выберет SQLite, зависит от статистики ANALYZE
+CREATE INDEX IF NOT EXISTS idx_prices_part_pricelist ON prices(part_id, price_list_id, price);
+CREATE INDEX IF NOT EXISTS idx_price_lists_supplier_active_date ON price_lists(supplier_id, is_active, upload_date DESC, id);
+-- Префикс idx_prices_part_pricelist - отдельный индекс больше не нужен
+DROP INDEX IF EXISTS idx_prices_composite;
+
+-- Полнотекстовый индекс каталога для поиска подстрок (триграммы вместо LIKE '%...%')
+CREATE VIRTUAL TABLE IF NOT EXISTS parts_catalog_fts USING fts5(
+    main_article,
+    additional_article,
+    name_ru,
+    content='parts_catalog',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_parts_fts_insert
+AFTER INSERT ON parts_catalog
+BEGIN
+    INSERT INTO parts_catalog_fts (rowid, main_article, additional_article, name_ru)
+    VALUES (NEW.id, NEW.main_article, NEW.additional_article, NEW.name_ru);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_parts_fts_update
+AFTER UPDATE OF main_article, additional_article, name_ru ON parts_catalog
+BEGIN
+    INSERT INTO parts_catalog_fts (parts_catalog_fts, rowid, main_article, additional_article, name_ru)
+    VALUES ('delete', OLD.id, OLD.main_article, OLD.additional_article, OLD.name_ru);
+    INSERT INTO parts_catalog_fts (rowid, main_article, additional_article, name_ru)
+    VALUES (NEW.id, NEW.main_article, NEW.additional_article, NEW.name_ru);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_parts_fts_delete
+AFTER DELETE ON parts_catalog
+BEGIN
+    INSERT INTO parts_catalog_fts (parts_catalog_fts, rowid, main_article, additional_article, name_ru)
+    VALUES ('delete', OLD.id, OLD.main_article, OLD.additional_article, OLD.name_ru);
+END;
+
+-- Денормализованное имя бренда в каталоге
+CREATE TRIGGER IF NOT EXISTS trg_parts_brand_name_insert
+AFTER INSERT ON parts_catalog
+BEGIN
+    UPDATE parts_catalog
+    SET brand_name = (SELECT name FROM brands WHERE id = NEW.brand_id)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_parts_brand_name_update
+AFTER UPDATE OF brand_id ON parts_catalog
+BEGIN
+    UPDATE parts_catalog
+    SET brand_name = (SELECT name FROM brands WHERE id = NEW.brand_id)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_brands_name_update
+AFTER UPDATE OF name ON brands
+BEGIN
+    UPDATE parts_catalog SET brand_name = NEW.name WHERE brand_id = NEW.id;
+END;
+
+-- Актуальная цена продажи: пересчитывается по детали при любом изменении цен
+CREATE TRIGGER IF NOT EXISTS trg_latest_expected_price_insert
+AFTER INSERT ON expected_sale_prices
+BEGIN
+    INSERT OR REPLACE INTO latest_expected_price (part_id, price_id, price_rub, effective_date)
+    SELECT part_id, id, price_rub, effective_date
+    FROM expected_sale_prices
+    WHERE part_id = NEW.part_id
+    ORDER BY effective_date DESC, created_at DESC
+    LIMIT 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_latest_expected_price_update
+AFTER UPDATE OF part_id, price_rub, effective_date ON expected_sale_prices
+BEGIN
+    DELETE FROM latest_expected_price WHERE part_id IN (OLD.part_id, NEW.part_id);
+    INSERT OR REPLACE INTO latest_expected_price (part_id, price_id, price_rub, effective_date)
+    SELECT part_id, id, price_rub, effective_date
+    FROM (
+        SELECT 
+            part_id, id, price_rub, effective_date,
+            ROW_NUMBER() OVER (PARTITION BY part_id ORDER BY effective_date DESC, created_at DESC) as rn
+        FROM expected_sale_prices
+        WHERE part_id IN (OLD.part_id, NEW.part_id)
+    )
+    WHERE rn = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_latest_expected_price_delete
+AFTER DELETE ON expected_sale_prices
+BEGIN
+    DELETE FROM latest_expected_price WHERE part_id = OLD.part_id;
+    INSERT OR REPLACE INTO latest_expected_price (part_id, price_id, price_rub, effective_date)
+    SELECT part_id, id, price_rub, effective_date
+    FROM expected_sale_prices
+    WHERE part_id = OLD.part_id
+    ORDER BY effective_date DESC, created_at DESC
+    LIMIT 1;
+END;